@@ -1,5 +1,5 @@
 __version__ = "0.1.0"
 
 __all__ = [
-    "conf", "log", "packages", "util",
+    "bundle", "conf", "daemon", "fetch", "index", "jobs", "lock", "log", "packages", "runner", "sync", "util", "vcs", "verify", "view", "wheelhouse",
 ]
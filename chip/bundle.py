@@ -0,0 +1,280 @@
+"""
+Offline bundles of environments.  A bundle is a single compressed tar stream
+holding everything needed to set up an environment on a machine without
+network access:
+
+    lock.json         the env, its packages in install order and how each
+                      one is shipped
+    catalog.json      the catalog entries of those packages
+    store/<fullname>  prebuilt package trees, as installed in the package
+                      store (only usable with the same package home)
+    source/<fullname> the downloaded sources of packages to build on arrival
+
+Both writing and reading are a single sequential pass over the stream, so a
+bundle on shared storage is installed with one large read instead of many
+small fetches.
+"""
+import os
+import sys
+import json
+import shutil
+import tarfile
+import tempfile
+from contextlib import closing
+from pip.index import Link
+
+import conf
+import util
+import lock
+import sync
+import index
+import packages
+from log import createLogger
+logger = createLogger()
+cf = conf.read_conf()
+join = os.path.join
+
+LOCKFILE = 'lock.json'
+CATALOG = 'catalog.json'
+
+def install_order(pks):
+    """ The packages `pks` sorted so that dependencies come first """
+    order, seen = [], set()
+    names = set(pk.fullname for pk in pks)
+
+    def visit(pk):
+        if pk.fullname in seen:
+            return
+        seen.add(pk.fullname)
+        for dep in pk.dependencies:
+            if dep.fullname in names:
+                visit(dep)
+        order.append(pk)
+
+    for pk in sorted(pks, key=lambda p: p.fullname):
+        visit(pk)
+    return order
+
+def add_json(tar, name, obj):
+    tmp = tempfile.NamedTemporaryFile(delete=False)
+    try:
+        json.dump(obj, tmp, indent=4)
+        tmp.close()
+        tar.add(tmp.name, arcname=name)
+    finally:
+        os.remove(tmp.name)
+
+def bundle(env, output, sources=False, compression='gz'):
+    """
+    Write the bundle of the environment `env` to the file `output` ('-' for
+    stdout).  Installed packages are shipped as prebuilt trees unless
+    `sources` is set, all others as their downloaded sources.
+    """
+    env = env or conf.get_env_current()
+    roots = conf.env_load(env)
+    pks = install_order(packages.resolve(roots))
+
+    modes = {}
+    for pk in pks:
+        if pk.isinstalled() and not sources:
+            modes[pk.fullname] = 'tree'
+        elif pk.url:
+            modes[pk.fullname] = 'source'
+        else:
+            modes[pk.fullname] = 'none'
+
+    lockdata = {
+        "env": env,
+        "roots": roots,
+        "home": cf['home'],
+        "packages": [pk.fullname for pk in pks],
+        "modes": modes,
+        "date": util.date_to_iso(),
+    }
+
+    if output == '-':
+        tar = tarfile.open(fileobj=sys.stdout, mode='w|'+compression)
+    else:
+        tar = tarfile.open(output, mode='w|'+compression)
+
+    with closing(tar):
+        add_json(tar, LOCKFILE, lockdata)
+        add_json(tar, CATALOG, [pk.metadata for pk in pks])
+
+        for pk in pks:
+            mode = modes[pk.fullname]
+            logger.info("Bundling %s (%s)" % (pk.fullname, mode))
+
+            if mode == 'tree':
+                tar.add(pk.store_path, arcname='store/'+pk.fullname)
+            elif mode == 'source':
+                tmp = tempfile.mkdtemp()
+                try:
+                    src = join(tmp, 'src')
+                    # an install of pk downloads to the same cache
+                    with pk.locked():
+                        pk.download_url(Link(pk.url), src)
+                    # git checkouts are worktrees of the local mirror
+                    tar.add(src, arcname='source/'+pk.fullname,
+                        exclude=lambda n: os.path.basename(n) == '.git')
+                finally:
+                    shutil.rmtree(tmp)
+
+    return lockdata
+
+#=============================================================================
+# installing from a bundle
+#=============================================================================
+def merge_catalog(entries):
+    """ Add the catalog entries missing from the local package file """
+    pkfile = cf['pkfile']
+    pks = []
+    if os.path.exists(pkfile):
+        with open(pkfile) as f:
+            pks = json.load(f)
+
+    have = set(util.format_pk_name(p['name'], p['version']) for p in pks)
+    new = [
+        p for p in entries if
+            util.format_pk_name(p['name'], p['version']) not in have
+    ]
+
+    if new or not os.path.exists(pkfile):
+        if not os.path.isdir(os.path.dirname(pkfile)):
+            os.makedirs(os.path.dirname(pkfile))
+        with lock.atomic_write(pkfile) as f:
+            json.dump(pks + new, f, indent=4)
+        util.gpks = None
+        packages._packages.clear()
+    return len(new)
+
+def read_json(tar, member):
+    return json.load(tar.extractfile(member))
+
+def safe(name):
+    return not (os.path.isabs(name) or '..' in name.split('/'))
+
+def inside(path, root):
+    path, root = os.path.realpath(path), os.path.realpath(root)
+    return path == root or path.startswith(root+os.sep)
+
+def check_member(member, root):
+    """
+    Refuse a member that would be written outside of `root`: through a
+    symlink extracted earlier, or as a symlink pointing out of `root`
+    """
+    dest = join(root, member.name)
+    if member.issym():
+        escapes = not inside(os.path.dirname(dest), root) or not inside(
+                join(os.path.dirname(dest), member.linkname), root)
+    elif member.islnk():
+        escapes = not safe(member.linkname) or not inside(dest, root)
+    else:
+        escapes = not inside(dest, root)
+    if escapes:
+        raise util.ChipRuntimeError("Unsafe path %r in bundle" % member.name)
+
+def unbundle(path, jobs=None):
+    """
+    Install an environment from the bundle at `path` ('-' for stdin) in one
+    sequential read of the stream.  Prebuilt trees are committed as they
+    are read, source packages are built once the whole stream is read.
+    """
+    if path == '-':
+        tar = tarfile.open(fileobj=sys.stdin, mode='r|*')
+    else:
+        tar = tarfile.open(path, mode='r|*')
+
+    lockdata, current, held = None, None, None
+    committed, built = [], []
+
+    def finish():
+        if current is None:
+            return
+        pk, mode = current
+        if mode == 'tree':
+            lock.atomic_symlink(os.path.relpath(pk.store_path, cf['home']),
+                    pk.base_path)
+            index.add(pk.fullname, [d.fullname for d in pk.dependencies],
+                    packages.build_index)
+            committed.append(pk.fullname)
+        elif mode == 'source':
+            open(join(pk.store_path, 'downloaded'), 'a').close()
+            built.append(packages.pkg_obj(pk.fullname, search=False))
+        if held:
+            held.__exit__(None, None, None)
+
+    with closing(tar):
+        for member in tar:
+            if not safe(member.name):
+                raise util.ChipRuntimeError("Unsafe path %r in bundle" % member.name)
+
+            if member.name == LOCKFILE:
+                lockdata = read_json(tar, member)
+                continue
+            if member.name == CATALOG:
+                merge_catalog(read_json(tar, member))
+                continue
+            if lockdata is None:
+                raise util.ChipRuntimeError("Bundle does not start with "+LOCKFILE)
+
+            kind, rest = member.name.split('/', 1)[0], member.name.split('/')[1:]
+            fullname, inner = rest[0], '/'.join(rest[1:])
+            mode = lockdata['modes'].get(fullname)
+
+            if current is None or current[0].fullname != fullname:
+                finish()
+                current, held = None, None
+
+                # only paths are needed here, the package class of a custom
+                # package may not be loadable before its sources are read
+                pk = packages.Package(fullname, search=False)
+                if pk.isinstalled():
+                    current = (pk, 'skip')
+                    continue
+                if mode == 'tree' and lockdata['home'] != cf['home']:
+                    raise util.ChipRuntimeError(
+                        "%s is prebuilt for the package home %s, not %s. "
+                        "Bundle with --sources to move between homes." %
+                        (fullname, lockdata['home'], cf['home'])
+                    )
+
+                held = pk.locked()
+                held.__enter__()
+                if os.path.exists(pk.store_path):
+                    shutil.rmtree(pk.store_path)
+                pk.mkdir_ext(pk.store_path)
+                current = (pk, mode)
+
+            if current[1] == 'skip':
+                continue
+
+            pk = current[0]
+            if kind == 'store':
+                member.name = inner or '.'
+                check_member(member, pk.store_path)
+                tar.extract(member, pk.store_path)
+            elif kind == 'source':
+                member.name = inner or '.'
+                check_member(member, pk.build_path)
+                tar.extract(member, pk.build_path)
+
+        finish()
+
+    if lockdata is None:
+        raise util.ChipRuntimeError("%s is not a chip bundle" % path)
+
+    for fullname, mode in lockdata['modes'].iteritems():
+        pk = packages.pkg_obj(fullname, search=False)
+        if mode == 'none' and not pk.isinstalled():
+            built.append(pk)
+
+    failed = sync.execute(built, jobs) if built else []
+
+    env = lockdata['env']
+    if env not in conf.get_env_all():
+        conf.env_save(lockdata['roots'], env)
+
+    logger.info("Unbundled %s: %d prebuilt, %d built" %
+            (env, len(committed), len(built) - len(failed)))
+    return lockdata, failed
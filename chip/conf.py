@@ -1,9 +1,28 @@
+"""
+Everything chip keeps about a user lives in a single file, state.json:
+
+    {
+        "conf":        {"url": ..., "home": ..., "pkfile": ...},
+        "current-env": "<env>",
+        "envs":        {"<env>": ["<package>", ...], ...},
+        "setup":       true          (once ~/.bashrc puts chop on the PATH)
+    }
+
+It is read once per process and cached.  Every change is a transaction: the
+state file is locked, read again so changes of other chip processes are not
+lost, modified and then atomically replaced.  The first time a user runs chip
+the state is created, migrating chip.json, status.json and envs/*.json of
+older versions.  ~/.bashrc is set up once, when an env is first exported.
+"""
 import os
 import re
 import json
 import stat
 import string
 import subprocess
+from contextlib import contextmanager
+
+import lock
 
 join = os.path.join
 
@@ -11,71 +30,153 @@ _HOME_DIR = os.path.expanduser("~")
 _DEFAULT_CONF_DIR = join(_HOME_DIR, ".kim-chip")
 _DEFAULT_CONF_FILE = join(_DEFAULT_CONF_DIR, "chip.json")
 DEFAULT_LOG_PATH = join(_DEFAULT_CONF_DIR, 'chip.log')
+DAEMON_SOCKET = join(_DEFAULT_CONF_DIR, 'chipd.sock')
+RUNS_PATH = join(_DEFAULT_CONF_DIR, 'runs')
 
 from log import createLogger
 logger = createLogger(DEFAULT_LOG_PATH)
 
 #=============================================================================
-# functions that handle the global configuration
-#=============================================================================
-_DEFAULT_FIELDS = {
-    "url": "https://raw.githubusercontent.com/mattbierbaum/chip/master/tests/packages.json",
-    "home":  join(_HOME_DIR, "openkim-packages"),
-    "pkfile": join(_HOME_DIR, "openkim-packages", "packages.json")
-}
-
-def write_conf(cf):
-    with open(_DEFAULT_CONF_FILE, 'w') as f:
-        logger.debug("Writing conf to %s" % _DEFAULT_CONF_FILE)
-        json.dump(cf, f, indent=4)
-
-def initialize_conf_if_empty():
-    logger.debug("Initializing configuration file with defaults.")
-
-    if not os.path.exists(_DEFAULT_CONF_DIR):
-        subprocess.check_call(['mkdir', '-p', _DEFAULT_CONF_DIR])
-
-    if not os.path.exists(_DEFAULT_CONF_FILE):
-        write_conf(_DEFAULT_FIELDS)
-
-def read_conf():
-    initialize_conf_if_empty()
-
-    with open(_DEFAULT_CONF_FILE) as f:
-        conf = json.load(f)
-
-    for key in _DEFAULT_FIELDS.keys():
-        if not key in conf:
-            raise KeyError("'%s' not found in chip.json" % key)
-
-    return conf
-
-#=============================================================================
-# the section that deals with the user-frontend configuration
+# the state store: configuration, current env and env definitions
 #=============================================================================
 _DEFAULT_ENVS_DIR = join(_DEFAULT_CONF_DIR, "envs")
 _STATUS_FILE = join(_DEFAULT_CONF_DIR, "status.json")
+_STATE_FILE = join(_DEFAULT_CONF_DIR, "state.json")
 _CHOP_FILE = join(_DEFAULT_CONF_DIR, "chop")
 _BASHRC = join(_HOME_DIR, '.bashrc')
 _ENVEXT = '.json'
 
+_DEFAULT_FIELDS = {
+    "url": "https://raw.githubusercontent.com/mattbierbaum/chip/master/tests/packages.json",
+    "home":  join(_HOME_DIR, "openkim-packages"),
+    "pkfile": join(_HOME_DIR, "openkim-packages", "packages.json")
+}
+
 _DEFAULT_STATUS = {
     "current-env": "default",
 }
 
+_state = None
+
 def add_path_bashrc():
+    """ Put chop on the PATH in ~/.bashrc, False when there is no bashrc """
     export = "export PATH="+_DEFAULT_CONF_DIR+":$PATH"
 
     if not os.path.exists(_BASHRC):
-        raise Exception("Expecting bash, error!")
-    else:
-        with open(_BASHRC) as f:
-            contents = f.read()
+        logger.warning("No %s, add `%s` to the startup file of your shell" %
+                (_BASHRC, export))
+        return False
+
+    with open(_BASHRC) as f:
+        contents = f.read()
 
     if not re.search(re.escape(export), contents):
         with open(_BASHRC, 'a') as f:
             f.write('\n'+export+'\n')
+    return True
+
+def read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+def migrate_state():
+    """ The state held in the files of older chip versions, or defaults """
+    state = {
+        "conf": read_json(_DEFAULT_CONF_FILE, dict(_DEFAULT_FIELDS)),
+        "current-env": read_json(_STATUS_FILE, _DEFAULT_STATUS)["current-env"],
+        "envs": {},
+    }
+
+    if os.path.isdir(_DEFAULT_ENVS_DIR):
+        for name in os.listdir(_DEFAULT_ENVS_DIR):
+            if name.endswith(_ENVEXT):
+                env = os.path.splitext(name)[0]
+                state['envs'][env] = read_json(join(_DEFAULT_ENVS_DIR, name), [])
+
+    if os.path.exists(_DEFAULT_CONF_FILE):
+        logger.info("Migrating chip configuration into %s" % _STATE_FILE)
+    return state
+
+def setup_state(state):
+    """ One time setup of a new state """
+    if not os.path.exists(_CHOP_FILE):
+        with open(_CHOP_FILE, 'w') as f:
+            f.write('')
+
+    state['envs'].setdefault(state['current-env'], [])
 
+def setup_shell():
+    """ Set up the user's shell for chop, unless that was done before """
+    if load_state().get('setup'):
+        return
+    if add_path_bashrc():
+        with transaction() as state:
+            state['setup'] = True
+
+def validate_state(state):
+    for key in _DEFAULT_FIELDS.keys():
+        if not key in state['conf']:
+            raise KeyError("'%s' not found in the chip configuration" % key)
+    return state
+
+def load_state():
+    """ The state of this user, read from disk on first use only """
+    global _state
+    if _state is None:
+        if os.path.exists(_STATE_FILE):
+            _state = validate_state(read_json(_STATE_FILE, None))
+        else:
+            with transaction() as state:
+                pass
+    return _state
+
+def reload_state():
+    """ Forget the cached state, for long running processes like chipd """
+    global _state
+    _state = None
+
+@contextmanager
+def transaction():
+    """
+    Change the state within the block: yields the current state from disk,
+    which is written back atomically when the block finishes.  Concurrent
+    transactions of other chip processes wait for this one to finish.
+    """
+    global _state
+    if not os.path.isdir(_DEFAULT_CONF_DIR):
+        os.makedirs(_DEFAULT_CONF_DIR)
+
+    with lock.filelock(_STATE_FILE+'.lock'):
+        if os.path.exists(_STATE_FILE):
+            state = read_json(_STATE_FILE, None)
+        else:
+            logger.debug("Initializing chip state in %s" % _STATE_FILE)
+            state = migrate_state()
+            setup_state(state)
+
+        yield state
+
+        validate_state(state)
+        with lock.atomic_write(_STATE_FILE) as f:
+            json.dump(state, f, indent=4)
+        _state = state
+
+#=============================================================================
+# functions that handle the global configuration
+#=============================================================================
+def write_conf(cf):
+    with transaction() as state:
+        logger.debug("Writing conf to %s" % _STATE_FILE)
+        state['conf'] = dict(cf)
+
+def read_conf():
+    return dict(load_state()['conf'])
+
+#=============================================================================
+# the section that deals with the user-frontend configuration
+#=============================================================================
 def chop_on_path():
     try:
         loc = subprocess.check_output(['which', 'chop'])
@@ -89,101 +190,64 @@ def chop_write(stuff):
     st = os.stat(_CHOP_FILE)
     os.chmod(_CHOP_FILE, st.st_mode | stat.S_IEXEC)
 
-def env_path(env):
-    return join(_DEFAULT_ENVS_DIR, env+_ENVEXT)
-
-def initialize_status_if_empty():
-    add_path_bashrc()
-
-    if not os.path.exists(_DEFAULT_ENVS_DIR):
-        subprocess.check_call(['mkdir', '-p', _DEFAULT_ENVS_DIR])
-
-    if not os.path.exists(_STATUS_FILE):
-        with open(_STATUS_FILE, 'w') as f:
-            json.dump(_DEFAULT_STATUS, f, indent=4)
-
-    if not os.path.exists(_CHOP_FILE):
-        with open(_CHOP_FILE, 'w') as f:
-            f.write('')
-
-    defaultenv = env_path(_DEFAULT_STATUS['current-env'])
-    if not os.path.exists(defaultenv):
-        with open(defaultenv, 'w') as f:
-            json.dump([], f, indent=4)
+def status_files():
+    """ Files holding the user's current env and the env definitions """
+    return [_STATE_FILE]
 
 def read_status():
-    initialize_status_if_empty()
-
-    with open(_STATUS_FILE) as f:
-        conf = json.load(f)
-
-    for key in _DEFAULT_STATUS.keys():
-        if not key in conf:
-            raise KeyError("'%s' not found in status.json" % key)
-    return conf
+    return {"current-env": load_state()['current-env']}
 
 def get_env_all():
-    envs = []
-    cf = read_conf()
-    for env in os.listdir(_DEFAULT_ENVS_DIR):
-        if env.endswith(_ENVEXT):
-            name, ext = os.path.splitext(env)
-            envs.append(name)
-    return envs
+    return sorted(load_state()['envs'].keys())
 
 def get_env_current():
-    cf = read_status()
-    return cf.get("current-env")
+    return load_state()['current-env']
 
 def env_del(env=''):
     if not env:
         raise util.ChipRuntimeError("Must specify env to delete")
 
-    os.remove(env_path(env))
+    with transaction() as state:
+        state['envs'].pop(env, None)
+        if state['current-env'] == env:
+            state['current-env'] = 'default'
+            state['envs'].setdefault('default', [])
 
 def env_switch(env=''):
     env = env or 'default'
-    cf = read_status()
-    cf['current-env'] = env
-
-    with open(_STATUS_FILE, 'w') as f:
-        json.dump(cf, f, indent=4)
-
-    if not os.path.exists(env_path(env)):
-        with open(env_path(env), 'w') as f:
-            json.dump([], f, indent=4)
+    with transaction() as state:
+        state['current-env'] = env
+        state['envs'].setdefault(env, [])
 
 def env_save(pks, env=''):
     env = env or get_env_current()
-    with open(env_path(env), 'w') as f:
-        json.dump(pks, f, indent=4)
+    with transaction() as state:
+        state['envs'][env] = list(pks)
 
 def env_load(env=''):
     env = env or get_env_current()
-    with open(env_path(env)) as f:
-        pks = json.load(f)
-    return pks
+    try:
+        return list(load_state()['envs'][env])
+    except KeyError:
+        raise KeyError("No chip environment %r" % env)
 
 def env_put(pk, env=''):
     env = env or get_env_current()
-    pks = env_load(env)
-    pks.append(str(pk))
-    env_save(pks, env)
+    with transaction() as state:
+        state['envs'].setdefault(env, []).append(str(pk))
 
 def env_pull(pk, env=''):
     env = env or get_env_current()
-    pks = env_load(env)
-    try:
-        pks.remove(pk)
-    except ValueError as e:
-        logger.error("Package %r is not part of environment %r" % (pk, env))
-    env_save(pks, env)
+    with transaction() as state:
+        try:
+            state['envs'].get(env, []).remove(pk)
+        except ValueError as e:
+            logger.error("Package %r is not part of environment %r" % (pk, env))
 
 def env_clear(env=''):
     env = env or get_env_current()
-    with open(env_path(env),'w') as f:
-        json.dump([], f, indent=4)
-
+    with transaction() as state:
+        state['envs'][env] = []
 
 shellscript = \
 """
@@ -0,0 +1,306 @@
+"""
+chipd, an optional resident process that keeps the package catalog, resolved
+environments and their search paths in memory.  It listens on a unix socket
+in the chip configuration directory and answers one json request per line:
+
+    {"cmd": "resolve", "packages": ["kim-api", "minimol@1.6.3"]}
+    {"cmd": "export", "env": "myenv", "view": false}
+    {"cmd": "env", "env": "myenv", "base": {"PATH": "/usr/bin"}}
+    {"cmd": "complete", "kind": "global", "prefix": "kim"}
+
+with {"ok": true, "result": ...} or {"ok": false, "error": "..."}.  Cached
+results are dropped when the package file, the environment definitions or
+the set of installed packages change.
+
+The functions `complete`, `export_paths` and `job_env` are what the command
+line uses: they ask the daemon when one is running and otherwise do the work
+in this process, so chip behaves the same with or without chipd.
+"""
+import os
+import sys
+import json
+import errno
+import socket
+import SocketServer
+
+import conf
+import util
+import view
+import packages
+from log import createLogger
+logger = createLogger()
+cf = conf.read_conf()
+join = os.path.join
+
+# seconds to wait on the daemon before falling back to working locally
+TIMEOUT = 5
+
+# seconds the daemon waits on a client for its request, well below TIMEOUT
+# so that clients queued behind a silent one are still answered
+REQUEST_TIMEOUT = 1
+
+#=============================================================================
+# the operations, performed locally or within the daemon
+#=============================================================================
+def complete_global(prefix):
+    pkgs = util.getpk()
+    if not util.VERSIONSEP in prefix:
+        names = sorted(set(pk['name'] for pk in pkgs))
+        return [n for n in names if n.startswith(prefix)]
+
+    fullnames = [util.format_pk_name(o['name'], o['version']) for o in pkgs]
+    return [fn for fn in fullnames if fn.startswith(prefix)]
+
+def complete_installed(prefix):
+    pkgs = util.getpk()
+    fullnames = [util.format_pk_name(o['name'], o['version']) for o in pkgs]
+    return [
+        fn for fn in fullnames if (
+            fn.startswith(prefix) and
+            packages.Package(fn, search=False).isinstalled()
+        )
+    ]
+
+def complete_active(prefix):
+    pks = conf.env_load()
+    pks.sort()
+    return [pk for pk in pks if pk.startswith(prefix)]
+
+def complete_envs(prefix):
+    return [e for e in conf.get_env_all() if e.startswith(prefix)]
+
+COMPLETERS = {
+    "global": complete_global,
+    "installed": complete_installed,
+    "active": complete_active,
+    "envs": complete_envs,
+}
+
+def local_export(env='', useview=False):
+    env = env or conf.get_env_current()
+    paths = packages.env_paths(packages.resolve(conf.env_load(env)))
+    if useview:
+        return view.update(env, paths)
+    return dict(paths)
+
+def merge_env(paths, base):
+    """ The environment `base` with the search paths `paths` prepended """
+    env = dict(base)
+    sep = os.path.pathsep
+    for var, value in paths.iteritems():
+        env[var] = value+sep+env[var] if env.get(var) else value
+    return env
+
+#=============================================================================
+# the server
+#=============================================================================
+class ChipDaemon(SocketServer.UnixStreamServer):
+    """
+    Requests are answered one at a time: activating packages changes the
+    process environment, which is not safe to do from several threads.
+    """
+    def __init__(self, path, *args, **kwargs):
+        SocketServer.UnixStreamServer.__init__(self, path, ChipHandler,
+                *args, **kwargs)
+        self.stamp = {}
+        self.clear()
+
+    def clear(self, *kinds):
+        kinds = kinds or ('catalog', 'envs', 'installs')
+        if 'catalog' in kinds:
+            util.gpks = None
+            packages._packages.clear()
+            self.resolved = {}
+        if 'envs' in kinds:
+            conf.reload_state()
+        if 'catalog' in kinds or 'envs' in kinds:
+            self.exports = {}
+        if 'catalog' in kinds or 'installs' in kinds:
+            self.completions = {}
+            self.exports = {}
+
+    def stat(self, paths):
+        stamp = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamp.append((path, st.st_mtime, st.st_size, st.st_ino))
+            except OSError:
+                stamp.append((path, None))
+        return stamp
+
+    def reload_conf(self):
+        """
+        Read the configuration again after the state file changed.  Every
+        module took its own copy of it on import, those are updated in place.
+        """
+        conf.reload_state()
+        new = conf.read_conf()
+        if new == cf:
+            return
+        logger.info("chipd: configuration changed, using %s" % new['home'])
+        for mod in sys.modules.values():
+            if getattr(mod, 'conf', None) is conf and isinstance(
+                    getattr(mod, 'cf', None), dict):
+                mod.cf.clear()
+                mod.cf.update(new)
+        self.stamp = {}
+
+    def invalidate(self):
+        """ Drop the caches depending on files changed since last request """
+        state = self.stat(conf.status_files())
+        if self.stamp.get('envs') != state:
+            self.reload_conf()
+
+        current = {
+            'catalog': self.stat([cf['pkfile']]),
+            'envs': state,
+            'installs': self.stat([cf['home'], join(cf['home'], '.store')]),
+        }
+        changed = [k for k,v in current.iteritems() if self.stamp.get(k) != v]
+        if changed:
+            logger.debug("chipd: %s changed, clearing caches" % changed)
+            self.clear(*changed)
+        self.stamp = current
+
+    def resolve(self, pknames):
+        key = tuple(pknames)
+        if key not in self.resolved:
+            pks = packages.resolve(pknames)
+            self.resolved[key] = [pk.fullname for pk in pks]
+        return self.resolved[key]
+
+    def export(self, env='', useview=False):
+        env = env or conf.get_env_current()
+        key = (env, bool(useview))
+        if key not in self.exports:
+            self.exports[key] = local_export(env, useview)
+        return self.exports[key]
+
+    def handle_request_json(self, req):
+        self.invalidate()
+        cmd = req.get('cmd')
+
+        if cmd == 'ping':
+            return True
+        if cmd == 'resolve':
+            return self.resolve(req.get('packages', []))
+        if cmd == 'export':
+            return self.export(req.get('env', ''), req.get('view', False))
+        if cmd == 'env':
+            paths = self.export(req.get('env', ''), req.get('view', False))
+            return merge_env(paths, req.get('base') or {})
+        if cmd == 'complete':
+            key = (req.get('kind'), req.get('prefix', ''))
+            if key[0] in ('active', 'envs'):
+                return COMPLETERS[key[0]](key[1])
+            if key not in self.completions:
+                self.completions[key] = COMPLETERS[key[0]](key[1])
+            return self.completions[key]
+        if cmd == 'shutdown':
+            self.shutting_down = True
+            return True
+        raise util.ChipRuntimeError("Unknown chipd request %r" % cmd)
+
+class ChipHandler(SocketServer.StreamRequestHandler):
+    # requests are answered one at a time, a client that never sends its
+    # request must not hold up the others
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        try:
+            self.handle_lines()
+        except socket.timeout:
+            logger.debug("chipd: client sent no request in %ss" %
+                    REQUEST_TIMEOUT)
+
+    def handle_lines(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                result = self.server.handle_request_json(json.loads(line))
+                resp = {"ok": True, "result": result}
+            except Exception as e:
+                logger.debug("chipd: request failed, %r" % e)
+                resp = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(resp)+'\n')
+            self.wfile.flush()
+
+def serve(path=None):
+    path = path or conf.DAEMON_SOCKET
+
+    if os.path.exists(path):
+        if request('ping', path=path):
+            raise util.ChipRuntimeError("chipd is already running on %s" % path)
+        os.remove(path)
+
+    oldmask = os.umask(0077)
+    try:
+        server = ChipDaemon(path)
+    finally:
+        os.umask(oldmask)
+
+    server.shutting_down = False
+    logger.info("chipd listening on %s" % path)
+    try:
+        while not server.shutting_down:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+    logger.info("chipd stopped")
+
+#=============================================================================
+# the client side, falling back to local work when there is no daemon
+#=============================================================================
+def request(cmd, path=None, **kwargs):
+    """
+    Send a request to chipd and return its result.  Returns None when no
+    daemon is running or the daemon could not answer.
+    """
+    path = path or conf.DAEMON_SOCKET
+    if os.environ.get('CHIPNODAEMON') or not os.path.exists(path):
+        return None
+
+    msg = dict(kwargs, cmd=cmd)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(TIMEOUT)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(msg)+'\n')
+        data = sock.makefile().readline()
+    except socket.error as e:
+        if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            logger.debug("chipd did not answer: %r" % e)
+        return None
+    finally:
+        sock.close()
+
+    try:
+        resp = json.loads(data)
+    except ValueError:
+        return None
+    if not resp.get('ok'):
+        logger.debug("chipd error: %s" % resp.get('error'))
+        return None
+    return resp.get('result')
+
+def complete(kind, prefix):
+    result = request('complete', kind=kind, prefix=prefix)
+    if result is None:
+        result = COMPLETERS[kind](prefix)
+    return result
+
+def export_paths(env='', useview=False):
+    result = request('export', env=env, view=useview)
+    if result is None:
+        result = local_export(env, useview)
+    return result
+
+def job_env(env='', base=None, useview=False):
+    """ The full environment to run a command within the chip env `env` """
+    base = os.environ if base is None else base
+    result = request('env', env=env, base=dict(base), view=useview)
+    if result is None:
+        result = merge_env(local_export(env, useview), base)
+    return result
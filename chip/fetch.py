@@ -0,0 +1,210 @@
+"""
+Downloads of package archives over http(s).  Connections are kept alive and
+reused per host, a download interrupted by a dropped connection is resumed
+from where it stopped with a Range request, and when the catalog gives a
+sha256 for a package the archive is verified while it streams to disk.  At
+most MAX_DOWNLOADS downloads run at once for a package home, across all the
+chip processes using it, each holding one of the slot locks in
+<home>/.locks.  Downloads to the same file are locked against each other.
+"""
+import os
+import time
+import socket
+import hashlib
+import httplib
+import urllib
+import urlparse
+import threading
+
+import conf
+import lock
+import util
+from log import createLogger
+logger = createLogger()
+cf = conf.read_conf()
+join = os.path.join
+
+MAX_DOWNLOADS = 4
+RETRIES = 5
+TIMEOUT = 60
+CHUNK = 1 << 16
+
+_idle = {}
+_idle_lock = threading.Lock()
+
+#=============================================================================
+# a pool of keep-alive connections per host
+#=============================================================================
+def connection(scheme, netloc):
+    """ An idle connection to `netloc` from the pool or a new one """
+    key = (scheme, netloc)
+    with _idle_lock:
+        if _idle.get(key):
+            return key, _idle[key].pop()
+
+    proxy = urllib.getproxies().get(scheme)
+    if proxy and not urllib.proxy_bypass(netloc.split(':')[0]):
+        proxy = urlparse.urlsplit(proxy).netloc
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(proxy, timeout=TIMEOUT)
+            conn.set_tunnel(netloc)
+        else:
+            conn = httplib.HTTPConnection(proxy, timeout=TIMEOUT)
+    elif scheme == 'https':
+        conn = httplib.HTTPSConnection(netloc, timeout=TIMEOUT)
+    else:
+        conn = httplib.HTTPConnection(netloc, timeout=TIMEOUT)
+    return key, conn
+
+def release(key, conn, resp):
+    """ Return a connection whose response was fully read to the pool """
+    if resp.will_close:
+        conn.close()
+        return
+    with _idle_lock:
+        _idle.setdefault(key, []).append(conn)
+
+def close_all():
+    with _idle_lock:
+        for conns in _idle.values():
+            for conn in conns:
+                conn.close()
+        _idle.clear()
+
+def request(url, headers=None, redirects=5):
+    """ GET `url`, following redirects, returns (key, conn, response) """
+    for i in xrange(redirects+1):
+        parts = urlparse.urlsplit(url)
+        key, conn = connection(parts.scheme, parts.netloc)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?'+parts.query
+        if conn.host != parts.netloc.split(':')[0] and parts.scheme == 'http':
+            path = url
+
+        try:
+            conn.request('GET', path, headers=headers or {})
+            resp = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # a pooled connection may have been closed by the server
+            conn.close()
+            key, conn = connection(parts.scheme, parts.netloc)
+            conn.request('GET', path, headers=headers or {})
+            resp = conn.getresponse()
+
+        if resp.status in (301, 302, 303, 307, 308):
+            location = resp.getheader('location')
+            resp.read()
+            release(key, conn, resp)
+            url = urlparse.urljoin(url, location)
+            continue
+        return key, conn, resp
+
+    raise util.PackageError("Too many redirects for %s" % url)
+
+#=============================================================================
+# resumable, verified downloads
+#=============================================================================
+def file_hash(path, h=None):
+    h = h or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), ''):
+            h.update(chunk)
+    return h
+
+def verify(path, sha256):
+    if sha256 and file_hash(path).hexdigest() != sha256.lower():
+        raise util.PackageError("sha256 mismatch for %s" % path)
+
+def slots():
+    return [
+        join(cf['home'], '.locks', 'download-%d.lock' % i)
+            for i in xrange(MAX_DOWNLOADS)
+    ]
+
+def download(url, dest, sha256=None):
+    """
+    Download `url` to the file `dest`.  Data is streamed into dest.part,
+    which an earlier interrupted download may have left and which is then
+    resumed.  With `sha256` the download is checked before it is moved to
+    `dest`.  Processes downloading to the same `dest` take turns, and those
+    coming after the first find the file in place.
+    """
+    part = dest+'.part'
+
+    with lock.filelock(dest+'.lock'), lock.anylock(slots()):
+        if os.path.exists(dest):
+            verify(dest, sha256)
+            return dest
+
+        for attempt in xrange(RETRIES+1):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+
+            try:
+                key, conn, resp = request(url, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                logger.warning("Could not connect for %s (%r), retrying" % (url, e))
+                time.sleep(min(2**attempt, 30))
+                continue
+
+            if resp.status == 416:
+                # the partial file is not a prefix of this resource
+                resp.read()
+                release(key, conn, resp)
+                os.remove(part)
+                continue
+
+            if resp.status not in (200, 206):
+                resp.read()
+                release(key, conn, resp)
+                raise util.PackageError("Downloading %s failed: %d %s" %
+                        (url, resp.status, resp.reason))
+
+            if resp.status == 206:
+                start = resp.getheader('content-range', '').split()[-1].split('-')[0]
+                if start != str(offset):
+                    resp.read()
+                    release(key, conn, resp)
+                    os.remove(part)
+                    continue
+            else:
+                # the server ignored the range, start over
+                offset = 0
+
+            if offset:
+                logger.info("Resuming %s at %d bytes" % (url, offset))
+                h = file_hash(part) if sha256 else None
+                mode = 'ab'
+            else:
+                h = hashlib.sha256() if sha256 else None
+                mode = 'wb'
+
+            try:
+                with open(part, mode) as f:
+                    for chunk in iter(lambda: resp.read(CHUNK), ''):
+                        f.write(chunk)
+                        if h:
+                            h.update(chunk)
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                logger.warning("Download of %s interrupted (%r), resuming" % (url, e))
+                continue
+
+            length = resp.getheader('content-length')
+            if length and os.path.getsize(part) != offset + int(length):
+                conn.close()
+                logger.warning("Download of %s incomplete, resuming" % url)
+                continue
+            release(key, conn, resp)
+
+            if h and h.hexdigest() != sha256.lower():
+                os.remove(part)
+                raise util.PackageError("sha256 mismatch for %s" % url)
+
+            os.rename(part, dest)
+            return dest
+
+    raise util.PackageError("Could not download %s after %d attempts" %
+            (url, RETRIES+1))
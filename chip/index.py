@@ -0,0 +1,121 @@
+"""
+A persisted index of the dependencies between installed packages, kept in
+<home>/.index.json next to the packages themselves:
+
+    {
+        "requires":   {"<fullname>": ["<dependency fullname>", ...]},
+        "dependents": {"<fullname>": ["<dependent fullname>", ...]},
+        "envs":       {"<env>": {"roots": [...], "catalog": <mtime>,
+                                 "closure": ["<fullname>", ...]}}
+    }
+
+Both directions of the graph are stored and updated whenever a package is
+installed or uninstalled, so finding the packages that need a package only
+touches those packages.  The closures of environments are cached along with
+the env's packages and the catalog they were resolved against, and are
+resolved again once either changes.
+"""
+import os
+import json
+from contextlib import contextmanager
+
+import conf
+import lock
+from log import createLogger
+logger = createLogger()
+cf = conf.read_conf()
+join = os.path.join
+
+def index_path():
+    return join(cf['home'], '.index.json')
+
+def empty():
+    return {"requires": {}, "dependents": {}, "envs": {}}
+
+def read():
+    """ The index, or None when there is none yet """
+    if not os.path.exists(index_path()):
+        return None
+    with open(index_path()) as f:
+        return json.load(f)
+
+@contextmanager
+def transaction(build=None):
+    """
+    Yields the index to modify in the block, then writes it back.  When
+    there is no index yet, `build(data)` first fills in an empty one, so
+    that changes are never made to an index missing the earlier installs.
+    """
+    with lock.filelock(index_path()+'.lock'):
+        data = read()
+        if data is None:
+            data = empty()
+            if build:
+                build(data)
+        yield data
+        with lock.atomic_write(index_path()) as f:
+            json.dump(data, f, indent=4)
+
+def link(data, fullname, requires):
+    unlink(data, fullname)
+    data['requires'][fullname] = sorted(requires)
+    for dep in requires:
+        rdeps = data['dependents'].setdefault(dep, [])
+        if fullname not in rdeps:
+            rdeps.append(fullname)
+            rdeps.sort()
+
+def unlink(data, fullname):
+    for dep in data['requires'].pop(fullname, []):
+        rdeps = data['dependents'].get(dep, [])
+        if fullname in rdeps:
+            rdeps.remove(fullname)
+        if not rdeps:
+            data['dependents'].pop(dep, None)
+
+def add(fullname, requires, build=None):
+    """ Record the installed package `fullname` needing `requires` """
+    with transaction(build) as data:
+        link(data, fullname, requires)
+
+def remove(fullname, build=None):
+    with transaction(build) as data:
+        unlink(data, fullname)
+
+def dependents(data, fullname, recursive=False):
+    """
+    The installed packages that need `fullname`.  With `recursive`, also
+    the packages needing those, ordered so that each package comes before
+    the packages it needs.
+    """
+    direct = data['dependents'].get(fullname, [])
+    if not recursive:
+        return list(direct)
+
+    order, seen = [], set()
+    def visit(name):
+        for rdep in data['dependents'].get(name, []):
+            if rdep not in seen:
+                seen.add(rdep)
+                visit(rdep)
+                order.append(rdep)
+    visit(fullname)
+    return order
+
+def catalog_stamp():
+    try:
+        return os.path.getmtime(cf['pkfile'])
+    except OSError:
+        return None
+
+def env_closure(data, env, roots):
+    """ The cached closure of the env `env`, None if it is out of date """
+    entry = data['envs'].get(env)
+    if entry and entry['roots'] == roots and entry['catalog'] == catalog_stamp():
+        return entry['closure']
+    return None
+
+def set_env_closure(data, env, roots, closure):
+    data['envs'][env] = {
+        "roots": roots, "catalog": catalog_stamp(), "closure": sorted(closure)
+    }
@@ -0,0 +1,176 @@
+"""
+Running commands inside a chip environment.  The environment is resolved
+once, by chipd when it is running, into a complete process environment that
+is handed straight to each command, so no shell, `chip export` or `. chop`
+is involved per command.
+
+A batch is a list of commands, one per line, split like a shell would split
+them but run without one.  Blank lines and lines starting with '#' are
+skipped.  The commands of a batch run at most `jobs` at a time, each with
+its output in its own log, and their exit statuses are collected in a
+summary.json next to the logs.  Interrupting a batch kills its running
+commands, and the summary then lists the jobs that had finished.
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import conf
+import util
+import runner
+import daemon
+from log import createLogger
+logger = createLogger()
+join = os.path.join
+
+# seconds between checks for an interrupt while waiting on a batch
+POLL = 1.0
+
+class Result(object):
+    def __init__(self, index, cmd, status, returncode, seconds, log):
+        self.index = index
+        self.cmd = cmd
+        self.status = status
+        self.returncode = returncode
+        self.seconds = seconds
+        self.log = log
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+    def to_dict(self):
+        return dict(
+            index=self.index, cmd=self.cmd, status=self.status,
+            returncode=self.returncode, seconds=self.seconds, log=self.log
+        )
+
+def read_jobs(path):
+    """ The commands of the job list `path` ('-' for stdin) as argv lists """
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        return [
+            shlex.split(line) for line in f
+                if line.strip() and not line.strip().startswith('#')
+        ]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def run(cmd, env='', useview=False):
+    """ Run `cmd` in the chip env `env` on this terminal, returns its status """
+    environ = daemon.job_env(env, useview=useview)
+    try:
+        return subprocess.call(cmd, env=environ)
+    except OSError as e:
+        logger.error("Could not run %s: %s" % (cmd[0], e))
+        return 127
+
+#=============================================================================
+# batches
+#=============================================================================
+def run_job(index, cmd, environ, log, timeout=None, group=None):
+    start = time.time()
+    status, returncode = 'ok', 0
+    try:
+        runner.run(cmd, log, prefix='job %d' % index, timeout=timeout,
+                env=environ, group=group)
+    except subprocess.CalledProcessError as e:
+        status, returncode = 'failed', e.returncode
+    except util.CommandTimeout:
+        status, returncode = 'timeout', None
+    except OSError as e:
+        with open(log, 'a') as f:
+            f.write("%s\n" % e)
+        status, returncode = 'failed', 127
+    except Exception as e:
+        logger.error("Job %d could not be run: %r" % (index, e))
+        status, returncode = 'error', None
+    if group is not None and group.stopped and status != 'ok':
+        status = 'interrupted'
+    return Result(index, cmd, status, returncode, time.time() - start, log)
+
+def write_summary(logdir, results):
+    with open(join(logdir, 'summary.json'), 'w') as f:
+        json.dump([r.to_dict() for r in results], f, indent=4)
+
+def batch(cmds, env='', jobs=None, logdir=None, timeout=None, useview=False):
+    """
+    Run the commands `cmds` in the chip env `env`, up to `jobs` at once.
+    Every command runs in its own process already, so the pool only needs
+    threads to wait on them.  Returns the results in the order of `cmds`
+    and the directory with the logs.
+    """
+    environ = daemon.job_env(env, useview=useview)
+    jobs = jobs or multiprocessing.cpu_count()
+
+    if not logdir:
+        if not os.path.isdir(conf.RUNS_PATH):
+            os.makedirs(conf.RUNS_PATH)
+        logdir = tempfile.mkdtemp(prefix=time.strftime('%Y%m%d-%H%M%S-'),
+                dir=conf.RUNS_PATH)
+    elif not os.path.isdir(logdir):
+        os.makedirs(logdir)
+
+    width = len(str(len(cmds)))
+    logs = [
+        join(logdir, 'job-%0*d.log' % (width, i)) for i in xrange(len(cmds))
+    ]
+
+    results, finished_lock, count = [None]*len(cmds), threading.Lock(), [0]
+    pool = ThreadPool(min(jobs, max(len(cmds), 1)))
+    group = runner.Group()
+
+    def job(index, cmd):
+        # recorded from the worker thread, the pool's result handler is
+        # gone once the pool is terminated on an interrupt
+        finished(run_job(index, cmd, environ, logs[index], timeout, group))
+
+    def finished(result):
+        with finished_lock:
+            results[result.index] = result
+            count[0] += 1
+            done = count[0]
+        if result.ok:
+            logger.debug("[%d/%d] job %d ok in %.1fs" %
+                    (done, len(cmds), result.index, result.seconds))
+        else:
+            logger.error("[%d/%d] job %d %s: %s (see %s)" % (done, len(cmds),
+                    result.index, result.status, ' '.join(result.cmd), result.log))
+
+    try:
+        pending = [pool.apply_async(job, (i, cmd)) for i, cmd in enumerate(cmds)]
+        pool.close()
+        # joining the pool cannot be interrupted on python 2, and the jobs
+        # run in sessions of their own which do not see the Ctrl-C either
+        for task in pending:
+            while True:
+                try:
+                    task.get(POLL)
+                    break
+                except multiprocessing.TimeoutError:
+                    continue
+    except KeyboardInterrupt:
+        logger.error("Interrupted, stopping the running jobs")
+        group.kill()
+        pool.terminate()
+        pool.join()
+        write_summary(logdir, [r for r in results if r is not None])
+        raise
+    pool.join()
+
+    write_summary(logdir, results)
+    return results, logdir
+
+def summary(results, logdir):
+    failed = [r for r in results if not r.ok]
+    seconds = sum(r.seconds for r in results)
+    return "%d jobs, %d ok, %d failed, %.1fs of job time, logs in %s" % (
+        len(results), len(results) - len(failed), len(failed), seconds, logdir)
@@ -0,0 +1,92 @@
+"""
+Helpers for changing files that other chip processes may be using at the
+same time: advisory file locks and atomic replacement of files and links.
+"""
+import os
+import time
+import fcntl
+import errno
+from contextlib import contextmanager
+
+def open_lockfile(path):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+
+@contextmanager
+def filelock(path, shared=False):
+    """
+    Hold an flock on `path` (created if needed) for the duration of the
+    block, waiting for other holders to release it first.
+    """
+    fd = open_lockfile(path)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+@contextmanager
+def anylock(paths, poll=0.2):
+    """
+    Hold an flock on the first of `paths` that is free, waiting until one
+    is.  With a lock file per slot this bounds the holders across all
+    processes and threads to len(paths).
+    """
+    fds = [open_lockfile(path) for path in paths]
+    try:
+        held = None
+        while held is None:
+            for fd in fds:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    continue
+                held = fd
+                break
+            else:
+                time.sleep(poll)
+        try:
+            yield
+        finally:
+            fcntl.flock(held, fcntl.LOCK_UN)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+def tmpname(path):
+    return "%s.tmp-%d" % (path, os.getpid())
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """
+    Open a temporary file next to `path` for writing and move it over
+    `path` once the block finishes, so readers see either the old or the
+    new contents and never a partial file.
+    """
+    tmp = tmpname(path)
+    try:
+        with open(tmp, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def atomic_symlink(target, path):
+    """ Create or replace the symlink `path` -> `target` in one step """
+    tmp = tmpname(path)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.rename(tmp, path)
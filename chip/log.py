@@ -66,3 +66,10 @@ def setLevel(level=logging.INFO):
         if isinstance(l, logging.StreamHandler):
             l.setLevel(level)
             l.setFormatter(log_formatter)
+
+def setStream(stream):
+    """ Send the console output elsewhere, e.g. when stdout carries data """
+    logger = logging.getLogger('chip')
+    for l in logger.handlers:
+        if type(l) is logging.StreamHandler:
+            l.stream = stream
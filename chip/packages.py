@@ -19,6 +19,7 @@ called package.json which contains:
         "version":  "<semver version>",
         "date":     "creation date",
         "url":      "location of package to download",
+        "sha256":   "checksum of the archive at url (optional)",
         "data":     "<See more info>",
         "requires": {
             "package-name-1":  "<version>",
@@ -46,7 +47,9 @@ import os
 import re
 import json
 import sys
+import imp
 import shutil
+import hashlib
 import subprocess
 import functools
 import argparse
@@ -56,10 +59,18 @@ from string import Template
 from contextlib import contextmanager, nested
 from pip.index import Link
 from pip.download import (unpack_vcs_link, is_vcs_url, is_file_url,
-                          unpack_file_url, unpack_http_url)
+                          unpack_file_url, url_to_path, get_file_content)
+from pip.util import unpack_file
 
 import conf
 import util
+import lock
+import runner
+import vcs
+import fetch
+import index
+import verify
+import wheelhouse
 from log import createLogger
 logger = createLogger()
 cf = conf.read_conf()
@@ -70,17 +81,24 @@ def wrap_install(func):
         if self.isinstalled():
             return True
 
-        self.bootstrap()
-
         for dep in self.dependencies:
             dep.install()
 
-        managers = [o.active() for o in self.dependencies]
-        with nested(*managers):
-            logger.info("Installing %s ..." % self.fullname)
-            func(self)
+        with self.locked():
+            if self.isinstalled():
+                logger.info("Package %s installed by another process" % self)
+                return True
+            if os.path.isdir(self.base_path) and not os.path.islink(self.base_path):
+                logger.info("Rebuilding %s, installed by an older chip" % self)
+
+            self.bootstrap()
+
+            managers = [o.active() for o in self.dependencies]
+            with nested(*managers):
+                logger.info("Installing %s ..." % self.fullname)
+                func(self)
 
-        self.finalize_install()
+            self.finalize_install()
         logger.debug("Finalized installation for %s" % self.fullname)
         return True
 
@@ -118,44 +136,104 @@ def wrap_default(action):
 # The main package class - subclasses made with decorators
 #=============================================================================
 class Package(object):
-    def __init__(self, name, versionrange='', pkfile=None, search=True):
-        metadata = None
+    """
+    A handle on a single version of a package.  Handles are small: only the
+    name and activation state are stored, while the catalog metadata and
+    the installation paths are looked up when they are first used.  Use
+    `pkg_obj` to get the one shared handle for a given fullname.
+    """
+    __slots__ = ('name', 'version', 'fullname', 'pkfile', 'env', 'activated',
+                 'deps', '_metadata')
 
+    def __init__(self, name, versionrange='', pkfile=None, search=True):
         self.pkfile = pkfile or cf['pkfile']
-        self.name, self.version = util.separate_fullname(name)
 
-        if not self.version and search:
-            if versionrange:
-                match = util.get_match_version(
-                            self.name, versionrange, self.pkfile
-                        )
-            else:
-                match = util.get_latest_version(self.name, self.pkfile)
-        else:
-            match = name
+        if search:
+            name = util.resolve_fullname(name, versionrange, self.pkfile)
 
-        self.name, self.version = util.separate_fullname(match)
+        self.name, self.version = util.separate_fullname(name)
         self.fullname = util.format_pk_name(self.name, self.version)
-        self.metadata = util.get_metadata(self.fullname)
-        self.shortname = self.name
-
-        self.base_path = join(cf['home'], self.fullname)
-        self.install_path = join(self.base_path, "install")
-        self.build_path = join(self.base_path, "build")
-        self.log_path = join(self.base_path, "log")
-        self.log = join(self.log_path, "chip.log")
-
-        self.pkgfile = join(self.base_path, 'package.json')
-        self.pkgpy = join(self.build_path, 'package.py')
-
-        self.ptype = self.metadata.get('type')
-        self.url = self.metadata.get('url')
-        self.requirements = self.metadata.get("requires")
-        self.data = self.metadata.get('data')
 
         self.env = {}
         self.activated = False
         self.deps = None
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = util.get_metadata(self.fullname, self.pkfile)
+        return self._metadata
+
+    @property
+    def shortname(self):
+        return self.name
+
+    @property
+    def base_path(self):
+        return join(cf['home'], self.fullname)
+
+    @property
+    def store_path(self):
+        return join(cf['home'], '.store', self.fullname)
+
+    @property
+    def lock_path(self):
+        return join(cf['home'], '.locks', self.fullname+'.lock')
+
+    @property
+    def install_path(self):
+        return join(self.store_path, "install")
+
+    @property
+    def build_path(self):
+        return join(self.store_path, "build")
+
+    @property
+    def log_path(self):
+        return join(self.store_path, "log")
+
+    @property
+    def log(self):
+        return join(self.log_path, "chip.log")
+
+    @property
+    def pkgfile(self):
+        return join(self.store_path, 'package.json')
+
+    @property
+    def pkgpy(self):
+        return join(self.build_path, 'package.py')
+
+    @property
+    def ptype(self):
+        return self.metadata.get('type')
+
+    @property
+    def url(self):
+        return self.metadata.get('url')
+
+    @property
+    def requirements(self):
+        return self.metadata.get("requires")
+
+    @property
+    def data(self):
+        return self.metadata.get('data')
+
+    @property
+    def timeout(self):
+        return (self.data or {}).get('timeout')
+
+    @property
+    def interactive(self):
+        """ Whether the commands of the build run sudo, which may prompt """
+        data = self.data or {}
+        return any(
+            'sudo' in c.split()
+                for key in ('commands', 'build-commands')
+                for c in data.get(key, [])
+        )
 
     def check_consistency():
         consistent, bads = self.consistent()
@@ -164,37 +242,64 @@ class Package(object):
                 "Package is inconsistent, these versions don't match:\n%r" % bads
             )
 
+    def locked(self):
+        return lock.filelock(self.lock_path)
+
     def bootstrap(self):
-        self.mkdir_ext(self.base_path)
+        """
+        Prepare the package store and download the sources, call with the
+        package lock held.  A download completed by an earlier, interrupted
+        install is reused.
+        """
+        self.mkdir_ext(self.store_path)
         self.mkdir(self.log_path)
-        self.mkdir(self.build_path)
         self.mkdir(self.install_path)
 
         if not os.path.exists(self.pkgfile):
-            with open(self.pkgfile, 'w') as f:
+            with lock.atomic_write(self.pkgfile) as f:
                 json.dump(self.metadata, f, indent=4)
 
-        if self.url:
+        downloaded = join(self.store_path, 'downloaded')
+        if self.url and not os.path.exists(downloaded):
             logger.info("Downloading %s" % self.url)
-            shutil.rmtree(self.build_path)
+            if os.path.exists(self.build_path):
+                shutil.rmtree(self.build_path)
             self.download_url(Link(self.url))
+            open(downloaded, 'a').close()
+
+        self.mkdir(self.build_path)
 
     def download_url(self, link, location=None):
-        cache = join(self.base_path, '.cache')
-        self.mkdir(cache)
+        # the store directory is missing when bundling a package's sources
+        cache = join(self.store_path, '.cache')
+        self.mkdir_ext(cache)
 
         location = location or self.build_path
-        if is_vcs_url(link):
+        if is_vcs_url(link) and link.url.startswith('git+'):
+            return vcs.checkout(link.url, location)
+        elif is_vcs_url(link):
             return unpack_vcs_link(link, location, only_download=False)
         elif is_file_url(link):
+            path = url_to_path(link.url_without_fragment)
+            if os.path.isfile(path):
+                fetch.verify(path, self.sha256(link))
             return unpack_file_url(link, location)
         else:
-            return unpack_http_url(link, location,
-                    cache, False)
+            path = join(cache, link.filename)
+            if not os.path.exists(path):
+                fetch.download(link.url_without_fragment, path, self.sha256(link))
+            return unpack_file(path, location, None, link)
+
+    def sha256(self, link):
+        """ Expected checksum of the archive at `link`, if any is known """
+        if self.metadata.get('sha256'):
+            return self.metadata['sha256']
+        if link.hash_name == 'sha256':
+            return link.hash
 
     @property
     def dependencies(self):
-        if not self.deps:
+        if self.deps is None:
             deps = []
             for req, ver_req in self.requirements.iteritems():
                 pkg = pkg_obj(name=req, versionrange=ver_req, pkfile=self.pkfile)
@@ -210,7 +315,7 @@ class Package(object):
         return a.compatible()
 
     def isinstalled(self):
-        return os.path.exists(join(self.base_path, 'installed'))
+        return is_installed(self.fullname)
 
     def isactive(self):
         return self.activated
@@ -246,20 +351,30 @@ class Package(object):
         if not os.path.isdir(extendedpath):
             subprocess.check_call(['mkdir', '-p', extendedpath])
 
-    def run(self, cmd):
-        with open(self.log, 'a') as log:
-            logger.info('  '+' '.join(cmd))
-            if 'sudo' in cmd:
-                p = subprocess.Popen(cmd, stderr=log, stdout=log, stdin=sys.stdin)
-                p.communicate()
-            else:
-                subprocess.check_call(cmd, stdout=log, stderr=log)
+    def run(self, cmd, cwd=None, env=None):
+        logger.info('  '+' '.join(cmd))
+        runner.run(cmd, self.log, prefix=self.fullname, timeout=self.timeout,
+                cwd=cwd, env=env)
 
     def haspy(self):
         return os.path.exists(self.pkgpy)
 
     def finalize_install(self):
-        open(join(self.base_path, 'installed'), 'a').close()
+        """
+        Commit the install.  Builds embed their prefix, so they happen in
+        place in the package store and only become visible when the link
+        <home>/<fullname> pointing at the store is atomically renamed into
+        place.
+        """
+        verify.write_manifest(self)
+        open(join(self.store_path, 'installed'), 'a').close()
+
+        if os.path.isdir(self.base_path) and not os.path.islink(self.base_path):
+            shutil.rmtree(self.base_path)
+        lock.atomic_symlink(os.path.relpath(self.store_path, cf['home']),
+                self.base_path)
+        index.add(self.fullname, [d.fullname for d in self.dependencies],
+                build_index)
 
     @wrap_install
     def install(self):
@@ -275,7 +390,15 @@ class Package(object):
 
     def uninstall(self):
         logger.info("Deleting package %s" % self.fullname)
-        shutil.rmtree(self.base_path)
+        with self.locked():
+            if os.path.islink(self.base_path):
+                os.remove(self.base_path)
+            elif os.path.isdir(self.base_path):
+                shutil.rmtree(self.base_path)
+
+            if os.path.isdir(self.store_path):
+                shutil.rmtree(self.store_path)
+            index.remove(self.fullname, build_index)
 
     @contextmanager
     def active(self):
@@ -318,10 +441,15 @@ class Package(object):
 # Python package class
 #=============================================================================
 class PythonPackage(Package):
-    def __init__(self, *args, **kwargs):
-        super(PythonPackage, self).__init__(*args, **kwargs)
-        self.pythonpath = join(self.install_path, 'lib/python2.7/site-packages')
-        self.pythonbinpath = join(self.install_path, 'bin')
+    __slots__ = ()
+
+    @property
+    def pythonpath(self):
+        return join(self.install_path, 'lib/python2.7/site-packages')
+
+    @property
+    def pythonbinpath(self):
+        return join(self.install_path, 'bin')
 
     @wrap_install
     def install(self):
@@ -329,9 +457,14 @@ class PythonPackage(Package):
             self.mkdir_ext(self.pythonpath)
             self.mkdir_ext(self.pythonbinpath)
 
-            with self.active(), self.indir(self.build_path):
-                self.run(['python', 'setup.py', 'install',
-                    '--prefix='+self.install_path])
+            with self.active():
+                whl = wheelhouse.wheel(self)
+                if not whl:
+                    self.run(['python', 'setup.py', 'install',
+                        '--prefix='+self.install_path], cwd=self.build_path)
+
+            if whl:
+                wheelhouse.unpack(whl, self)
         else:
             raise util.PackageError(
                 "No setup.py found for package %s" % self.fullname
@@ -352,11 +485,11 @@ class PythonPackage(Package):
 #=============================================================================
 #=============================================================================
 class BinaryPackage(Package):
-    def __init__(self, *args, **kwargs):
-        super(BinaryPackage, self).__init__(*args, **kwargs)
+    __slots__ = ()
 
-        if self.data:
-            self.linkname = self.data.get('linkname')
+    @property
+    def linkname(self):
+        return (self.data or {}).get('linkname')
 
     @wrap_install
     def install(self):
@@ -383,15 +516,23 @@ class BinaryPackage(Package):
 #=============================================================================
 #=============================================================================
 class KIMAPIPackageV1(Package):
-    def __init__(self, *args, **kwargs):
-        super(KIMAPIPackageV1, self).__init__(*args, **kwargs)
+    __slots__ = ()
 
-        self.bindir = join(self.install_path, 'bin')
-        self.libdir = join(self.install_path, 'lib')
-        self.incdir = join(self.install_path, 'include/kim-api')
+    @property
+    def bindir(self):
+        return join(self.install_path, 'bin')
 
-        if self.data:
-            self.buildcommands = self.data['build-commands']
+    @property
+    def libdir(self):
+        return join(self.install_path, 'lib')
+
+    @property
+    def incdir(self):
+        return join(self.install_path, 'include/kim-api')
+
+    @property
+    def buildcommands(self):
+        return self.data['build-commands']
 
     @wrap_install
     def install(self):
@@ -435,10 +576,11 @@ class KIMAPIPackageV1(Package):
 #=============================================================================
 #=============================================================================
 class APTPackage(Package):
-    def __init__(self, *args, **kwargs):
-        super(APTPackage, self).__init__(*args, **kwargs)
-        if self.data:
-            self.commands = self.data['commands']
+    __slots__ = ()
+
+    @property
+    def commands(self):
+        return self.data['commands']
 
     @wrap_install
     def install(self):
@@ -454,62 +596,175 @@ class APTPackage(Package):
     def deactivate(self):
         pass
 
-def pkg_obj(name, *args, **kwargs):
-    typedict = {
-        "meta": Package,
-        "apt": APTPackage,
-        "pip": APTPackage,
-        "python": PythonPackage,
-        "binary": BinaryPackage,
-        'kimapi-v1': KIMAPIPackageV1,
-    }
-    p = Package(name=name, *args, **kwargs)
-
-    if p.ptype == 'custom':
-        if not os.path.exists(p.pkgpy):
-            p.bootstrap()
-
-        sys.path.append(p.build_path)
-        import package
-        cls = package.pkg
-        sys.path.remove(p.build_path)
-    else:
-        cls = typedict[p.ptype]
-
-    return cls(name, *args, **kwargs)
+#=============================================================================
+# custom packages, whose class is defined in the package.py of their source
+#=============================================================================
+GITHUB_URL = re.compile(
+    r'^git\+https?://github\.com/([^/]+)/([^/@]+?)(?:\.git)?@([^#]+)'
+)
+GITHUB_RAW = "https://raw.githubusercontent.com/{0}/{1}/{2}/package.py"
+
+_custom_modules = {}
+
+def custom_pkgpy(pk):
+    """
+    Find the package.py defining the class of the custom package `pk`,
+    downloading as little as possible.  The full source is only fetched
+    when there is no way to get package.py alone.
+    """
+    if os.path.exists(pk.pkgpy):
+        return pk.pkgpy
+
+    cached = join(cf['home'], '.custom', pk.fullname+'.py')
+    if os.path.exists(cached):
+        return cached
+
+    link = Link(pk.url or '')
+    github = GITHUB_URL.match(link.url)
+
+    if is_file_url(link):
+        path = join(url_to_path(link.url_without_fragment), 'package.py')
+        if os.path.exists(path):
+            return path
+    elif github:
+        url = GITHUB_RAW.format(*github.groups())
+        logger.info("Downloading %s" % url)
+        url, content = get_file_content(url)
+
+        pk.mkdir_ext(os.path.dirname(cached))
+        with open(cached+'.tmp', 'w') as f:
+            f.write(content)
+        os.rename(cached+'.tmp', cached)
+        return cached
+
+    with pk.locked():
+        pk.bootstrap()
+    return pk.pkgpy
+
+def custom_class(pk):
+    """
+    Load the class `pkg` from the package.py of a custom package.  Each
+    distinct package.py gets its own module, named after the hash of its
+    contents, so custom packages in the same process never see each other's
+    classes and identical files are only executed once.
+    """
+    path = custom_pkgpy(pk)
+    with open(path) as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+
+    module = _custom_modules.get(digest)
+    if module is None:
+        name = 'chip_custom_'+digest
+        sys.path.insert(0, os.path.dirname(path))
+        try:
+            module = imp.load_source(name, path)
+        finally:
+            sys.path.remove(os.path.dirname(path))
+        _custom_modules[digest] = module
+
+    try:
+        return module.pkg
+    except AttributeError:
+        raise util.PackageError(
+            "No class 'pkg' defined in package.py of %s" % pk.fullname
+        )
+
+PACKAGE_TYPES = {
+    "meta": Package,
+    "apt": APTPackage,
+    "pip": APTPackage,
+    "python": PythonPackage,
+    "binary": BinaryPackage,
+    'kimapi-v1': KIMAPIPackageV1,
+}
+
+_packages = {}
+
+def pkg_class(fullname, pkfile=None):
+    ptype = util.get_metadata(fullname, pkfile).get('type')
+
+    if ptype == 'custom':
+        return custom_class(Package(fullname, pkfile=pkfile, search=False))
+
+    try:
+        return PACKAGE_TYPES[ptype]
+    except KeyError:
+        raise util.PackageSupportError(
+            "Unknown type %r for package %s" % (ptype, fullname)
+        )
+
+def is_installed(fullname):
+    """
+    Installs are links into the package store.  Directories of the same name
+    are left from the layout of older chip versions, whose paths no longer
+    match, and count as not installed so that they are rebuilt.
+    """
+    path = join(cf['home'], fullname)
+    return os.path.islink(path) and os.path.exists(join(path, 'installed'))
+
+def pkg_obj(name, versionrange='', pkfile=None, search=True):
+    """
+    Get the package handle for `name`, resolving the version first if
+    needed.  Handles are shared, there is one instance per fullname.
+    """
+    if search:
+        name = util.resolve_fullname(name, versionrange, pkfile)
+
+    pk = _packages.get(name)
+    if pk is None:
+        cls = pkg_class(name, pkfile)
+        pk = _packages[name] = cls(name, pkfile=pkfile, search=False)
+    return pk
 
 
 #==============================================================================
 # gathering complete lists, triming, and checking consistency
 #==============================================================================
 class CompatibleVersionDict(dict):
+    """
+    Packages grouped by name.  Within a name, only the newest version of each
+    compatible-release bucket (the versions matched by '~= version') is kept,
+    so merging a dependency list is a single pass with one dictionary lookup
+    per package.  Only a version missing from the buckets is compared with
+    the others of its name, as releases of different lengths like 1.6 and
+    1.6.3 may still be compatible.  A name left with more than one version
+    is a conflict.
+    """
     def __init__(self, pklist=[], *args, **kwargs):
         super(CompatibleVersionDict, self).__init__(*args, **kwargs)
+        self.buckets = {}
+        self.flat = None
         if pklist:
             self.fromlist(pklist)
 
     def __setitem__(self, key, value):
-        done = False
-
-        pks = []
-        if self.get(key):
-            pks = self.get(key)
-            for i in xrange(len(pks)):
-                ver = pks[i].version
-                if util.compatible(ver, util.v2s(value.version)):
-                    if util.later(value.version, ver):
-                        pks[i] = value
-                    done = True
-
-            if not done:
-                pks.append(value)
-        else:
+        bucket = (key, util.compatible_bucket(value.version))
+        index = self.buckets.get(bucket)
+
+        pks = self.get(key)
+        if pks is None:
+            pks = []
+            super(CompatibleVersionDict, self).__setitem__(key, pks)
+
+        if index is None:
+            for i, pk in enumerate(pks):
+                if util.compatible_release(pk.version, value.version):
+                    index = self.buckets[bucket] = i
+                    break
+
+        if index is None:
+            self.buckets[bucket] = len(pks)
             pks.append(value)
-
-        super(CompatibleVersionDict, self).update({key: pks})
+        elif util.later(value.version, pks[index].version):
+            pks[index] = value
+        else:
+            return
+        self.flat = None
 
     def tolist(self):
-        return list(itertools.chain.from_iterable([v for k,v in self.iteritems()]))
+        if self.flat is None:
+            self.flat = list(itertools.chain.from_iterable(self.itervalues()))
+        return list(self.flat)
 
     def fromlist(self, pks):
         for pk in pks:
@@ -525,6 +780,11 @@ class CompatibleVersionDict(dict):
 
 
 class PathDict(dict):
+    """
+    Search path variables accumulated over several packages.  Values set
+    later are put in front of the existing ones and each directory appears
+    only once, at its first position.
+    """
     def __init__(self, paths=[], *args, **kwargs):
         super(PathDict, self).__init__(*args, **kwargs)
         if paths:
@@ -532,8 +792,133 @@ class PathDict(dict):
                 self.__setitem__(k,v)
 
     def __setitem__(self, key, value):
-        if self.get(key):
-            super(PathDict, self).update({key: value+":"+self.get(key)})
-        else:
-            super(PathDict, self).update({key: value})
+        sep = os.path.pathsep
+        dirs, seen = [], set()
+        for d in value.split(sep) + (self.get(key) or '').split(sep):
+            if d and d not in seen:
+                dirs.append(d)
+                seen.add(d)
+        super(PathDict, self).update({key: sep.join(dirs)})
+
+def resolve(pknames, pkfile=None):
+    """ The consistent set of packages needed by `pknames` and their deps """
+    allpks = []
+    for pk in pknames:
+        pk = pkg_obj(pk, pkfile=pkfile)
+        allpks.extend([pk]+pk.dependencies)
+    return CompatibleVersionDict(allpks).tolist()
+
+def env_paths(pks):
+    """ The search path variables contributed by the packages `pks` """
+    paths = []
+    for pk in pks:
+        paths.extend([[k, v] for k,v in pk.path_dict().iteritems()])
+    return PathDict(paths)
+
+#==============================================================================
+# what needs an installed package
+#==============================================================================
+def installed_packages():
+    """ Fullnames of all the packages installed in the package home """
+    if not os.path.isdir(cf['home']):
+        return []
+    return sorted(
+        d for d in os.listdir(cf['home']) if util.is_fullname(d) and
+            is_installed(d)
+    )
+
+def build_index(data):
+    """ Fill the empty index `data` in from the installed packages """
+    logger.info("Indexing the installed packages")
+    for fullname in installed_packages():
+        try:
+            pk = pkg_obj(fullname, search=False)
+            requires = [d.fullname for d in pk.dependencies]
+        except util.PackageNotFound as e:
+            logger.warning("Not indexing dependencies of %s: %s" % (fullname, e))
+            requires = []
+        index.link(data, fullname, requires)
+
+def load_index():
+    """ The dependency index, built from the installed packages if missing """
+    data = index.read()
+    if data is None:
+        with index.transaction(build_index) as data:
+            pass
+    return data
+
+def dependents(pk, recursive=False):
+    """ The installed packages needing `pk`, see index.dependents """
+    return [
+        name for name in index.dependents(load_index(), pk.fullname, recursive)
+            if is_installed(name)
+    ]
+
+def env_closures():
+    """
+    The fullnames needed by each env, resolving only envs that changed, and
+    the envs that could not be resolved, whose needs are unknown
+    """
+    data = load_index()
+    envs = conf.get_env_all()
+    closures, stale, unresolved = {}, {}, []
+
+    for env in envs:
+        roots = conf.env_load(env)
+        closure = index.env_closure(data, env, roots)
+        if closure is None:
+            try:
+                closure = [pk.fullname for pk in resolve(roots)]
+            except util.PackageNotFound as e:
+                logger.warning("Skipping env %s: %s" % (env, e))
+                unresolved.append(env)
+                continue
+            stale[env] = (roots, closure)
+        closures[env] = closure
+
+    if stale or set(data['envs']) - set(envs):
+        with index.transaction(build_index) as data:
+            for env, (roots, closure) in stale.iteritems():
+                index.set_env_closure(data, env, roots, closure)
+            for env in set(data['envs']) - set(envs):
+                del data['envs'][env]
+    return closures, unresolved
+
+def why(pk):
+    """ The installed packages and the envs needing `pk` """
+    closures = env_closures()[0]
+    envs = sorted(e for e, c in closures.iteritems() if pk.fullname in c)
+    return dependents(pk), envs
+
+def uninstall(pk, cascade=False, force=False):
+    """
+    Uninstall `pk` unless installed packages or envs still need it, or an
+    env that could not be resolved might.  With `cascade`, the installed
+    packages needing it are uninstalled first, and with `force` it is
+    uninstalled whatever needs it.
+    """
+    needed = dependents(pk, recursive=cascade)
+    closures, unresolved = env_closures()
+    envs = sorted(e for e, c in closures.iteritems() if pk.fullname in c)
+
+    if not force:
+        if needed and not cascade:
+            raise util.ChipRuntimeError(
+                "%s is needed by %s, uninstall them too with --cascade" %
+                (pk.fullname, ', '.join(needed))
+            )
+        if envs:
+            raise util.ChipRuntimeError(
+                "%s is needed by the envs %s, uninstall anyway with --force" %
+                (pk.fullname, ', '.join(envs))
+            )
+        if unresolved:
+            raise util.ChipRuntimeError(
+                "Could not resolve the envs %s, which may need %s, uninstall "
+                "anyway with --force" % (', '.join(unresolved), pk.fullname)
+            )
 
+    for name in needed:
+        pkg_obj(name, search=False).uninstall()
+    pk.uninstall()
+    return needed
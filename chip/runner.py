@@ -0,0 +1,137 @@
+"""
+Runs the external commands of package builds.  Output is streamed line by
+line into the package log as it is produced and can also be shown live on
+the console, prefixed with the package name so that concurrent builds can be
+told apart.  Commands that fail or run past their timeout raise, including
+those run through sudo.
+"""
+import os
+import sys
+import signal
+import threading
+import subprocess
+
+import util
+
+# echo build output to the console as well as to the package log
+LIVE = False
+
+# serializes console output so that lines of concurrent builds never mix
+_console = threading.Lock()
+
+def set_live(live=True):
+    global LIVE
+    LIVE = live
+
+def console(line, prefix=''):
+    with _console:
+        sys.stdout.write('[%s] %s' % (prefix, line) if prefix else line)
+        if not line.endswith('\n'):
+            sys.stdout.write('\n')
+        sys.stdout.flush()
+
+class Group(object):
+    """
+    Commands run from several threads that are stopped together, e.g. when
+    the user interrupts: `kill` ends the running ones and no more start.
+    """
+    def __init__(self):
+        self.kills = set()
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def add(self, kill):
+        with self.lock:
+            if self.stopped:
+                return False
+            self.kills.add(kill)
+            return True
+
+    def discard(self, kill):
+        with self.lock:
+            self.kills.discard(kill)
+
+    def kill(self):
+        with self.lock:
+            self.stopped = True
+            for kill in self.kills:
+                kill()
+
+def run(cmd, log, prefix='', timeout=None, cwd=None, env=None, live=None,
+        group=None):
+    """
+    Run `cmd` and append its combined stdout and stderr to the file `log`.
+
+    The working directory and environment are passed explicitly instead of
+    being set on this process, so several commands can run at once from
+    different threads.  Raises CalledProcessError for a non-zero exit status
+    and util.CommandTimeout when `timeout` seconds pass first.  A command
+    run in the Group `group` is killed along with it.
+    """
+    live = LIVE if live is None else live
+    interactive = 'sudo' in cmd
+
+    with open(log, 'a') as logfile:
+        logfile.write('$ %s\n' % ' '.join(cmd))
+        logfile.flush()
+
+        stdin = sys.stdin if interactive else open(os.devnull)
+        try:
+            p = subprocess.Popen(cmd, cwd=cwd, env=env, bufsize=1,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    stdin=stdin, preexec_fn=None if interactive else os.setsid,
+                    close_fds=True)
+        finally:
+            if stdin is not sys.stdin:
+                stdin.close()
+
+        def kill():
+            try:
+                if interactive:
+                    p.kill()
+                else:
+                    os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        if group is not None and not group.add(kill):
+            kill()
+
+        expired = []
+        def expire():
+            expired.append(True)
+            kill()
+
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            for line in iter(p.stdout.readline, ''):
+                logfile.write(line)
+                logfile.flush()
+                if live:
+                    console(line, prefix)
+            p.stdout.close()
+            ret = p.wait()
+        except BaseException:
+            # interrupted, or the log could not be written: leave no
+            # command running behind
+            kill()
+            p.stdout.close()
+            p.wait()
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+            if group is not None:
+                group.discard(kill)
+
+    if expired:
+        raise util.CommandTimeout(
+            "Command '%s' timed out after %s seconds" % (' '.join(cmd), timeout)
+        )
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
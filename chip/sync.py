@@ -0,0 +1,269 @@
+"""
+Reconciling an environment with the packages installed on this machine.  A
+sync first plans: the environment is resolved once and its packages are
+split into those to install and those already installed, and installed
+packages needed by no environment are reported as orphaned.  Orphans are
+only known when every environment could be resolved.  The plan is
+then executed by installing packages in parallel processes as soon as all of
+their dependencies are in place.  Packages whose builds run sudo are
+installed by chip itself instead, on the terminal sudo may prompt on.
+
+Catalog entries may carry optional "size" (bytes to download) and
+"build-time" (seconds) fields which are used to estimate the cost of a plan.
+"""
+import os
+import errno
+import Queue
+import traceback
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
+from pip.index import Link
+from pip.download import is_file_url, url_to_path
+
+import conf
+import util
+import packages
+from log import createLogger
+logger = createLogger()
+cf = conf.read_conf()
+join = os.path.join
+
+class Plan(object):
+    def __init__(self, env, closure, install, reuse, orphaned, unresolved):
+        self.env = env
+        self.closure = closure
+        self.install = install
+        self.reuse = reuse
+        self.orphaned = orphaned
+        self.unresolved = unresolved
+
+def plan(env=''):
+    env = env or conf.get_env_current()
+    closure = packages.resolve(conf.env_load(env))
+    installed = set(packages.installed_packages())
+
+    needed = set(pk.fullname for pk in closure)
+    closures, unresolved = packages.env_closures()
+    for fullnames in closures.itervalues():
+        needed.update(fullnames)
+
+    install = [pk for pk in closure if pk.fullname not in installed]
+    reuse = [pk for pk in closure if pk.fullname in installed]
+    # an env that does not resolve may need any installed package
+    orphaned = [] if unresolved else sorted(installed - needed)
+    return Plan(env, closure, install, reuse, orphaned, unresolved)
+
+def prune(p):
+    """
+    Uninstall the orphans of the plan `p`, along with the orphans needing
+    them, returns the packages that could not be uninstalled
+    """
+    if p.unresolved:
+        raise util.ChipRuntimeError(
+            "Not pruning, the envs %s could not be resolved" %
+            ', '.join(p.unresolved)
+        )
+
+    failed = []
+    for fullname in p.orphaned:
+        if not packages.is_installed(fullname):
+            continue
+        try:
+            packages.uninstall(packages.pkg_obj(fullname, search=False),
+                    cascade=True)
+        except util.ChipRuntimeError as e:
+            logger.error(str(e))
+            failed.append(fullname)
+    return failed
+
+#=============================================================================
+# cost estimates for a dry run
+#=============================================================================
+def download_size(pk):
+    size = pk.metadata.get('size')
+    if size is not None or not pk.url:
+        return size if pk.url else 0
+
+    link = Link(pk.url)
+    if is_file_url(link):
+        path = url_to_path(link.url_without_fragment)
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        total = 0
+        for root, dirs, files in os.walk(path):
+            total += sum(os.path.getsize(join(root, f)) for f in files)
+        return total
+    return None
+
+def build_time(pk):
+    return pk.metadata.get('build-time')
+
+def format_size(size):
+    if size is None:
+        return "unknown"
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return "%.1f %s" % (size, unit)
+        size /= 1024.
+
+def format_time(secs):
+    if secs is None:
+        return "unknown"
+    if secs < 60:
+        return "~%ds" % secs
+    return "~%dm%02ds" % (secs // 60, secs % 60)
+
+def summary(p):
+    lines = ["sync %s: %d packages, %d to install, %d reused, %d orphaned" % (
+        p.env, len(p.closure), len(p.install), len(p.reuse), len(p.orphaned))]
+
+    size, secs, nsize, nsecs = 0, 0, 0, 0
+    for pk in p.install:
+        s, t = download_size(pk), build_time(pk)
+        lines.append("  install   %-30s download %-10s build %s" % (
+            pk.fullname, format_size(s), format_time(t)))
+        if s is None:
+            nsize += 1
+        else:
+            size += s
+        if t is None:
+            nsecs += 1
+        else:
+            secs += t
+
+    for pk in p.reuse:
+        lines.append("  reuse     %s" % pk.fullname)
+    for fullname in p.orphaned:
+        lines.append("  orphaned  %s" % fullname)
+    if p.unresolved:
+        lines.append("orphans unknown, the envs %s could not be resolved" %
+                ', '.join(p.unresolved))
+
+    lines.append("estimated download %s%s, build %s%s" % (
+        format_size(size), " (+%d unknown)" % nsize if nsize else "",
+        format_time(secs), " (+%d unknown)" % nsecs if nsecs else ""))
+    return "\n".join(lines)
+
+#=============================================================================
+# executing a plan
+#=============================================================================
+# seconds between checks on the workers while waiting for results
+POLL = 1.0
+
+_started = None
+
+def init_worker(started):
+    global _started
+    _started = started
+
+def error(e):
+    return "%r\n%s" % (e, traceback.format_exc())
+
+def install_one(fullname):
+    """ Runs in a worker process, returns an error message on failure """
+    try:
+        _started.put((fullname, os.getpid()))
+        packages.pkg_obj(fullname, search=False).install()
+    except BaseException as e:
+        # anything escaping here, SystemExit included, would leave the
+        # task without a result and the parent waiting for it forever
+        return error(e)
+    return None
+
+def install_here(fullname):
+    """ Install in this process, returns an error message on failure """
+    try:
+        packages.pkg_obj(fullname, search=False).install()
+    except Exception as e:
+        return error(e)
+    return None
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def execute(pks, jobs=None):
+    """
+    Install the packages `pks` using up to `jobs` worker processes, and this
+    process for the packages running sudo.  Each package starts as soon as
+    the packages it depends on are installed.
+    Returns the fullnames of the packages that failed or could not be
+    installed because a dependency failed.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    todo = dict((pk.fullname, pk) for pk in pks)
+    deps = dict(
+        (name, set(d.fullname for d in pk.dependencies if d.fullname in todo))
+        for name, pk in todo.iteritems()
+    )
+
+    done, failed = set(), set()
+    results = Queue.Queue()
+    # written to without a feeder thread, so that a worker dying right after
+    # starting a package has still reported its pid
+    started = SimpleQueue()
+    pool = multiprocessing.Pool(min(jobs, max(len(todo), 1)),
+            init_worker, (started,))
+    running, here, pids, lost = set(), [], {}, False
+
+    try:
+        while todo or running:
+            for name in sorted(todo):
+                if deps[name] & failed:
+                    logger.error("Skipping %s, a dependency failed" % name)
+                    failed.add(name)
+                    del todo[name]
+                elif deps[name] <= done:
+                    running.add(name)
+                    if todo.pop(name).interactive:
+                        # the stdin of workers is not the terminal
+                        here.append(name)
+                    else:
+                        pool.apply_async(install_one, (name,),
+                            callback=lambda err, name=name: results.put((name, err)))
+
+            if not running:
+                break
+            if here:
+                name = here.pop(0)
+                results.put((name, install_here(name)))
+
+            # waiting with a timeout keeps Ctrl-C working on python 2 and
+            # notices workers that died without finishing their package
+            try:
+                name, err = results.get(timeout=POLL)
+            except Queue.Empty:
+                while not started.empty():
+                    name, pid = started.get()
+                    pids[name] = pid
+                for name in running:
+                    if name in pids and not alive(pids[name]):
+                        results.put((name, "the worker process died"))
+                        lost = True
+                continue
+
+            if name not in running:
+                continue
+            running.discard(name)
+            if err:
+                logger.error("Failed to install %s: %s" % (name, err))
+                failed.add(name)
+            else:
+                done.add(name)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        # the pool waits for the tasks of dead workers on close, forever
+        if lost:
+            pool.terminate()
+        else:
+            pool.close()
+    finally:
+        pool.join()
+
+    failed.update(todo)
+    return sorted(failed)
@@ -4,7 +4,7 @@ import json
 import time
 import datetime
 import subprocess
-from packaging.version import Version, Specifier
+from packaging.version import Version, Specifier, InvalidSpecifier
 from pip.download import get_file_content
 
 import conf
@@ -35,6 +35,9 @@ class PackageInconsistent(Exception):
 class PackageSupportError(Exception):
     pass
 
+class CommandTimeout(Exception):
+    pass
+
 #=============================================================================
 # general util functions
 #=============================================================================
@@ -49,6 +52,7 @@ def download_pkfile():
             f.write(content)
 
 gpks = None
+gindex = None
 
 def getpk(pkfile=None):
     global gpks
@@ -60,6 +64,22 @@ def getpk(pkfile=None):
         gpks = pks 
     return pks
 
+def getindex(pkfile=None):
+    """
+    Catalog lookup tables built once per loaded package file: a dict of name
+    to the list of its versions' metadata and a dict of fullname to metadata
+    """
+    global gindex
+    pks = gpks or getpk(pkfile)
+
+    if gindex is None or gindex[0] is not pks:
+        names, fullnames = {}, {}
+        for pk in pks:
+            names.setdefault(pk.get('name'), []).append(pk)
+            fullnames[format_pk_name(pk.get('name'), pk.get('version'))] = pk
+        gindex = (pks, names, fullnames)
+    return gindex[1], gindex[2]
+
 def is_fullname(name):
     return re.findall(VERSIONSEP, name)
 
@@ -74,11 +94,55 @@ def separate_fullname(fullname):
 #=============================================================================
 # dependency resolution and consistency checks
 #=============================================================================
+_versions = {}
+_specifiers = {}
+
+RELEASE = re.compile(r'^(?:(\d+)!)?(\d+(?:\.\d+)*)')
+
+def parse_version(ver):
+    v = _versions.get(ver)
+    if v is None:
+        v = _versions[ver] = Version(ver)
+    return v
+
+def parse_specifier(versionrange):
+    s = _specifiers.get(versionrange)
+    if s is None:
+        s = _specifiers[versionrange] = Specifier(versionrange)
+    return s
+
 def compatible(ver, versionrange):
-    return Version(ver) in Specifier(versionrange)
+    return parse_version(ver) in parse_specifier(versionrange)
 
 def later(ver1, ver2):
-    return Version(ver1) > Version(ver2)
+    return parse_version(ver1) > parse_version(ver2)
+
+def compatible_bucket(ver):
+    """
+    The set of versions matched by '~= ver', identified by the release
+    numbers without the last one, e.g. 1.6.3 -> (0, (1, 6)).  Single number
+    releases cannot be used with ~= and form a bucket of their own.
+    """
+    # the normalized form of a version starts with [epoch!]release
+    epoch, release = RELEASE.match(str(parse_version(ver))).groups()
+    epoch, release = int(epoch or 0), tuple(int(r) for r in release.split('.'))
+    if len(release) > 1:
+        return (epoch, release[:-1])
+    # longer than the buckets above, so that 1 is not bucketed with 1.x
+    return (epoch, release, None)
+
+def compatible_release(ver1, ver2):
+    """
+    Whether one of the versions is matched by '~=' the other, which may be
+    so across buckets when the releases differ in length (1.6 and 1.6.3)
+    """
+    for ver, other in ((ver1, ver2), (ver2, ver1)):
+        try:
+            if compatible(ver, v2s(other)):
+                return True
+        except InvalidSpecifier:
+            pass
+    return False
 
 def v2s(v):
     return "~= "+v
@@ -87,14 +151,13 @@ def v2s(v):
 # version searching and formatting routines
 #=============================================================================
 def get_latest_version(name, pkfile=None):
-    pks = gpks or getpk(pkfile)
+    names, fullnames = getindex(pkfile)
 
     currver = ''
-    for pk in pks:
-        tname = pk.get('name')
+    for pk in names.get(name, []):
         ver = pk.get('version')
 
-        if (tname == name and (not currver or later(ver, currver))):
+        if not currver or later(ver, currver):
             currver = ver
 
     if not currver:
@@ -102,14 +165,13 @@ def get_latest_version(name, pkfile=None):
     return format_pk_name(name, currver)
 
 def get_match_version(name, versionrange, pkfile=None):
-    pks = gpks or getpk(pkfile)
+    names, fullnames = getindex(pkfile)
 
     currver = ''
-    for pk in pks:
-        tname = pk.get('name')
+    for pk in names.get(name, []):
         ver = pk.get('version')
 
-        if (tname == name and compatible(ver, versionrange) and
+        if (compatible(ver, versionrange) and
                 (not currver or later(ver, currver))):
             currver = ver
 
@@ -118,12 +180,17 @@ def get_match_version(name, versionrange, pkfile=None):
                 (name, versionrange))
     return format_pk_name(name, currver)
 
-def get_metadata(fullname, pkfile=None):
-    pks = gpks or getpk(pkfile)
-    n, v = separate_fullname(fullname)
+def resolve_fullname(name, versionrange='', pkfile=None):
+    if is_fullname(name):
+        return name
+    if versionrange:
+        return get_match_version(name, versionrange, pkfile)
+    return get_latest_version(name, pkfile)
 
-    for pk in pks:
-        if n == pk.get('name') and v == pk.get('version'):
-            return pk
-    raise PackageNotFound("Package %s was not found." % fullname)
+def get_metadata(fullname, pkfile=None):
+    names, fullnames = getindex(pkfile)
 
+    try:
+        return fullnames[fullname]
+    except KeyError:
+        raise PackageNotFound("Package %s was not found." % fullname)
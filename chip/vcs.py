@@ -0,0 +1,117 @@
+"""
+A shared cache of git repositories for packages with git+ urls.  Every
+repository is kept once per package home as a bare mirror, which only fetches
+what it is missing: a pinned commit already in the mirror needs no network
+at all, and otherwise just that commit is fetched shallowly.  Package
+sources are checked out of the mirror as worktrees, so installing several
+versions of a repository, or reinstalling one, never clones it again.
+"""
+import os
+import re
+import hashlib
+import subprocess
+
+import conf
+import util
+import lock
+from log import createLogger
+logger = createLogger()
+cf = conf.read_conf()
+join = os.path.join
+
+SHA = re.compile(r'^[0-9a-fA-F]{4,40}$')
+
+def mirrors_path():
+    return join(cf['home'], '.git-mirrors')
+
+def parse_url(url):
+    """ Split git+<url>@<rev>#<fragment> into the repository url and rev """
+    url = url.split('#', 1)[0]
+    if url.startswith('git+'):
+        url = url[len('git+'):]
+
+    rev = None
+    path = url.split('://', 1)[-1]
+    if '@' in path.split('/', 1)[-1]:
+        url, rev = url.rsplit('@', 1)
+    return url, rev or 'HEAD'
+
+def mirror_path(url):
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', url.split('://', 1)[-1]).strip('_')
+    digest = hashlib.sha1(url).hexdigest()[:8]
+    return join(mirrors_path(), "%s-%s.git" % (name[-60:], digest))
+
+def git(args, mirror=None, cwd=None):
+    cmd = ['git'] + (['--git-dir='+mirror] if mirror else []) + args
+    logger.debug("  "+" ".join(cmd))
+    p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        raise util.PackageError("'%s' failed:\n%s" % (' '.join(cmd), out))
+    return out.strip()
+
+def resolve(mirror, rev):
+    try:
+        return git(['rev-parse', '--verify', '-q', rev+'^{commit}'], mirror)
+    except util.PackageError:
+        return None
+
+def fetch(url, rev):
+    """
+    Make sure the mirror of `url` has the commit `rev` and return the
+    mirror path and full commit id.  Commit ids present in the mirror are
+    used as is; branches and tags are always refreshed since they move.
+    """
+    mirror = mirror_path(url)
+
+    with lock.filelock(mirror+'.lock'):
+        if not os.path.isdir(mirror):
+            logger.info("Creating git mirror of %s" % url)
+            git(['init', '--bare', '-q', mirror])
+            git(['config', 'remote.origin.url', url], mirror)
+
+        sha = resolve(mirror, rev) if SHA.match(rev) else None
+        if sha:
+            logger.info("Using mirrored %s@%s" % (url, rev))
+            return mirror, sha
+
+        logger.info("Fetching %s@%s" % (url, rev))
+        try:
+            git(['fetch', '-q', '--depth', '1', 'origin', rev], mirror)
+            sha = resolve(mirror, 'FETCH_HEAD')
+            if SHA.match(rev) and not sha.startswith(rev.lower()):
+                sha = None
+        except util.PackageError:
+            sha = None
+
+        if not sha:
+            # abbreviated commit ids can not be fetched by themselves, so
+            # fall back to an incremental fetch of all branches and tags
+            if os.path.exists(join(mirror, 'shallow')):
+                args = ['fetch', '-q', '--unshallow', 'origin']
+            else:
+                args = ['fetch', '-q', 'origin']
+            git(args + ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*'],
+                    mirror)
+            sha = resolve(mirror, rev)
+
+        if not sha:
+            raise util.PackageNotFound("No commit %s in %s" % (rev, url))
+
+        # keep fetched commits reachable so that gc never drops them
+        git(['update-ref', 'refs/chip/'+sha, sha], mirror)
+    return mirror, sha
+
+def checkout(url, location):
+    """ Check out the git+ url `url` into the directory `location` """
+    repo, rev = parse_url(url)
+    mirror, sha = fetch(repo, rev)
+
+    if os.path.isdir(location) and not os.listdir(location):
+        os.rmdir(location)
+
+    with lock.filelock(mirror+'.lock'):
+        git(['worktree', 'prune'], mirror)
+        git(['worktree', 'add', '-f', '--detach', location, sha], mirror)
+    return location
@@ -0,0 +1,131 @@
+"""
+Integrity checks of installed packages.  When a package is installed, a
+manifest.json in its store directory records the size, mtime and sha256 of
+every file and the target of every symlink in the tree.  Logs, download
+caches, git metadata and chip's own markers are left out.
+
+`check` compares installed trees with their manifests, spreading the files
+of all packages over a pool of threads.  Files are hashed in chunks as they
+are read, and a fast check compares only sizes and mtimes.
+"""
+import os
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import util
+import lock
+import fetch
+from log import createLogger
+logger = createLogger()
+join = os.path.join
+
+MANIFEST = 'manifest.json'
+
+# not part of an installed tree: per-install state and caches
+SKIPPED_TOP = set(['log', '.cache', 'installed', 'downloaded', MANIFEST])
+SKIPPED = set(['.git'])
+
+def manifest_path(pk):
+    return join(pk.store_path, MANIFEST)
+
+def tree_entries(root):
+    """ Paths relative to `root` of the files and links of a tree """
+    for dirpath, dirs, files in os.walk(root):
+        skip = SKIPPED | SKIPPED_TOP if dirpath == root else SKIPPED
+        names = [f for f in files if f not in skip] + [
+            d for d in dirs if d not in skip and os.path.islink(join(dirpath, d))
+        ]
+        dirs[:] = sorted(d for d in dirs if d not in skip)
+        for name in sorted(names):
+            yield os.path.relpath(join(dirpath, name), root)
+
+def write_manifest(pk):
+    """ Record the current contents of the store directory of `pk` """
+    files, links = {}, {}
+    for rel in tree_entries(pk.store_path):
+        path = join(pk.store_path, rel)
+        if os.path.islink(path):
+            links[rel] = os.readlink(path)
+        else:
+            st = os.stat(path)
+            files[rel] = [st.st_size, int(st.st_mtime),
+                    fetch.file_hash(path).hexdigest()]
+
+    with lock.atomic_write(manifest_path(pk)) as f:
+        json.dump({
+            "package": pk.fullname, "date": util.date_to_iso(),
+            "files": files, "links": links
+        }, f, indent=1)
+
+def read_manifest(pk):
+    try:
+        with open(manifest_path(pk)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+#=============================================================================
+# checking installed trees
+#=============================================================================
+def check_file(task):
+    """ A description of what is wrong with one manifest entry, or None """
+    fullname, path, expected, fast = task
+    try:
+        if isinstance(expected, basestring):
+            if os.readlink(path) != expected:
+                return fullname, "%s: link changed" % path
+            return fullname, None
+
+        size, mtime, sha256 = expected
+        st = os.stat(path)
+        if st.st_size != size:
+            return fullname, "%s: size %d, expected %d" % (path, st.st_size, size)
+        if fast:
+            if int(st.st_mtime) != mtime:
+                return fullname, "%s: modified" % path
+        elif fetch.file_hash(path).hexdigest() != sha256:
+            return fullname, "%s: contents changed" % path
+    except (OSError, IOError) as e:
+        return fullname, "%s: %s" % (path, e.strerror.lower())
+    return fullname, None
+
+class Report(object):
+    def __init__(self):
+        self.checked = []
+        self.broken = {}
+        self.unverified = []
+
+def check(pks, fast=False, jobs=None):
+    """
+    Compare the installed packages `pks` with their manifests using `jobs`
+    threads.  Packages installed before manifests existed are reported as
+    unverified.
+    """
+    report = Report()
+    tasks = []
+    for pk in pks:
+        if not os.path.exists(join(pk.store_path, 'installed')):
+            report.broken[pk.fullname] = ["not installed in %s" % pk.store_path]
+            continue
+
+        manifest = read_manifest(pk)
+        if manifest is None:
+            report.unverified.append(pk.fullname)
+            continue
+
+        report.checked.append(pk.fullname)
+        for rel, entry in manifest['files'].iteritems():
+            tasks.append((pk.fullname, join(pk.store_path, rel), entry, fast))
+        for rel, target in manifest['links'].iteritems():
+            tasks.append((pk.fullname, join(pk.store_path, rel), target, fast))
+
+    pool = ThreadPool(jobs or multiprocessing.cpu_count())
+    try:
+        for fullname, problem in pool.imap_unordered(check_file, tasks, 16):
+            if problem:
+                report.broken.setdefault(fullname, []).append(problem)
+    finally:
+        pool.close()
+        pool.join()
+    return report
@@ -0,0 +1,167 @@
+"""
+Merged views of environments.  Instead of putting one directory per package
+on each search path, a view is a single prefix per environment whose bin,
+lib, include and python directories are symlink farms pointing into the
+installed packages.  Exporting a view puts a single directory on each path.
+
+Entries provided by several packages are resolved the same way a search path
+would: the package earlier on the path wins.  Identical files are not
+conflicts and directories of the same name are merged, anything else is
+reported as a conflict.  The links of a view are recorded in a manifest so
+that updates after adding or removing packages only touch what changed.
+"""
+import os
+import json
+import shutil
+import filecmp
+
+import conf
+import lock
+from log import createLogger
+logger = createLogger()
+cf = conf.read_conf()
+join = os.path.join
+
+# where the directories on each search path are merged to within a view
+VIEW_DIRS = {
+    "PATH": "bin",
+    "PYTHONPATH": "python",
+    "LIBRARY_PATH": "lib",
+    "LD_LIBRARY_PATH": "lib",
+    "C_INCLUDE_PATH": "include",
+    "CPLUS_INCLUDE_PATH": "include",
+}
+
+MANIFEST = '.chip-view.json'
+
+def view_path(env):
+    return join(cf['home'], '.views', env)
+
+def exists(env):
+    return os.path.exists(join(view_path(env), MANIFEST))
+
+def same(a, b):
+    if os.path.realpath(a) == os.path.realpath(b):
+        return True
+    if os.path.isfile(a) and os.path.isfile(b):
+        return filecmp.cmp(a, b, shallow=False)
+    return False
+
+def merge(links, dirs, conflicts, rel, src):
+    """ Add the entry `src` at `rel` in the view, merging directories """
+    if rel in dirs:
+        if os.path.isdir(src):
+            for entry in sorted(os.listdir(src)):
+                merge(links, dirs, conflicts, join(rel, entry), join(src, entry))
+        else:
+            conflicts.append((rel, src))
+        return
+
+    cur = links.get(rel)
+    if cur is None:
+        links[rel] = src
+    elif same(cur, src):
+        pass
+    elif os.path.isdir(cur) and os.path.isdir(src):
+        del links[rel]
+        dirs.add(rel)
+        merge(links, dirs, conflicts, rel, cur)
+        merge(links, dirs, conflicts, rel, src)
+    else:
+        conflicts.append((rel, src))
+
+def plan(paths):
+    """
+    Compute the contents of a view from the search path variables `paths`.
+    Returns the links (view relative path -> source), the directories that
+    had to be merged, the conflicting entries that were shadowed and the
+    variables which cannot be merged into a view.
+    """
+    links, dirs, conflicts, others = {}, set(), [], {}
+
+    for var, value in sorted(paths.iteritems()):
+        sub = VIEW_DIRS.get(var)
+        if not sub:
+            others[var] = value
+            continue
+
+        for d in value.split(os.path.pathsep):
+            if not d or not os.path.isdir(d):
+                continue
+            for entry in sorted(os.listdir(d)):
+                merge(links, dirs, conflicts, join(sub, entry), join(d, entry))
+
+    return links, dirs, conflicts, others
+
+def read_manifest(root):
+    path = join(root, MANIFEST)
+    if not os.path.exists(path):
+        return {"links": {}, "dirs": []}
+    with open(path) as f:
+        return json.load(f)
+
+def remove(path):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+def update(env, paths):
+    """
+    Bring the view of `env` in line with the search path variables `paths`
+    and return the variables to export to use the view.  Only links that
+    were added, removed or retargeted since the last update are touched.
+    """
+    root = view_path(env)
+
+    with lock.filelock(root+'.lock'):
+        links, dirs, conflicts, others = plan(paths)
+        old = read_manifest(root)
+        oldlinks, olddirs = old['links'], set(old['dirs'])
+
+        for rel, src in oldlinks.iteritems():
+            if links.get(rel) != src:
+                remove(join(root, rel))
+        for rel in sorted(olddirs - dirs, reverse=True):
+            remove(join(root, rel))
+
+        for rel in sorted(dirs - olddirs):
+            path = join(root, rel)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                remove(path)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        for sub in set(VIEW_DIRS.values()):
+            if not os.path.isdir(join(root, sub)):
+                os.makedirs(join(root, sub))
+
+        changed = 0
+        for rel, src in links.iteritems():
+            path = join(root, rel)
+            if oldlinks.get(rel) == src and os.path.lexists(path):
+                continue
+            if os.path.lexists(path):
+                remove(path)
+            os.symlink(src, path)
+            changed += 1
+
+        with lock.atomic_write(join(root, MANIFEST)) as f:
+            json.dump({"links": links, "dirs": sorted(dirs)}, f, indent=4)
+
+    for rel, src in conflicts:
+        logger.warning("View conflict: %s from %s is shadowed by %s" %
+                (rel, src, links.get(rel, join(root, rel))))
+    logger.debug("Updated %d links in view %s" % (changed, root))
+
+    exports = dict(others)
+    for var in paths.keys():
+        if var in VIEW_DIRS:
+            exports[var] = join(root, VIEW_DIRS[var])
+    return exports
+
+def delete(env):
+    root = view_path(env)
+    with lock.filelock(root+'.lock'):
+        if os.path.isdir(root):
+            shutil.rmtree(root)
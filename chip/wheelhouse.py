@@ -0,0 +1,211 @@
+"""
+A local cache of wheels built from python packages.  Wheels are keyed by a
+hash of the package sources, the python used to build them and the packages
+active during the build, so a package is only run through setup.py once and
+every later install of the same sources is just an unpack of the wheel into
+the package's install path.
+
+Building wheels requires setuptools and the wheel package for the python on
+PATH.  When they are missing, `wheel` returns None and the package falls back
+to a plain setup.py install.
+"""
+import os
+import stat
+import glob
+import shutil
+import hashlib
+import zipfile
+import StringIO
+import ConfigParser
+import subprocess
+
+import conf
+import lock
+from log import createLogger
+logger = createLogger()
+cf = conf.read_conf()
+join = os.path.join
+
+# runs any setup.py, distutils based ones included, with setuptools loaded
+SETUPTOOLS_SHIM = (
+    "import setuptools, tokenize; __file__='setup.py'; "
+    "exec(compile(open(__file__).read().replace('\\r\\n', '\\n'), "
+    "__file__, 'exec'))"
+)
+
+# files and directories that do not influence the built wheel
+IGNORED = set(['.git', '.hg', '.svn', 'build', 'dist', '__pycache__'])
+
+_python = None
+
+def wheelhouse_path():
+    return join(cf['home'], '.wheelhouse')
+
+def build_python():
+    """ Version of the python on PATH and whether it can build wheels """
+    global _python
+    if _python is None:
+        try:
+            version = subprocess.check_output(['python', '-c',
+                'import sys; print(sys.version.split()[0])']).strip()
+            usable = subprocess.call(['python', '-c', 'import setuptools, wheel'],
+                stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT) == 0
+        except OSError:
+            version, usable = '', False
+        _python = (version, usable)
+    return _python
+
+def source_hash(path):
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(
+            d for d in dirs if d not in IGNORED and not d.endswith('.egg-info')
+        )
+        for f in sorted(files):
+            if f.endswith(('.pyc', '.pyo')):
+                continue
+            full = join(root, f)
+            h.update(os.path.relpath(full, path)+'\0')
+            if os.path.islink(full):
+                h.update(os.readlink(full))
+            else:
+                with open(full, 'rb') as fd:
+                    for chunk in iter(lambda: fd.read(1 << 16), ''):
+                        h.update(chunk)
+            h.update('\0')
+    return h.hexdigest()
+
+def wheel_key(pk):
+    h = hashlib.sha1()
+    h.update(source_hash(pk.build_path))
+    h.update(build_python()[0])
+    for dep in sorted(d.fullname for d in pk.dependencies):
+        h.update('\0'+dep)
+    return h.hexdigest()
+
+def find(path):
+    wheels = glob.glob(join(path, '*.whl'))
+    return wheels[0] if wheels else None
+
+def wheel(pk):
+    """
+    Path of the wheel for the sources of `pk`, building it first if it is
+    not in the wheelhouse yet.  Call with the package dependencies active.
+    """
+    version, usable = build_python()
+    if not usable:
+        logger.debug("No setuptools/wheel for python %s, not building wheels" % version)
+        return None
+
+    path = join(wheelhouse_path(), pk.name, wheel_key(pk))
+    whl = find(path)
+    if whl:
+        logger.info("Using cached wheel %s" % os.path.basename(whl))
+        return whl
+
+    with lock.filelock(path+'.lock'):
+        whl = find(path)
+        if whl:
+            return whl
+
+        tmp = lock.tmpname(path)
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+
+        try:
+            pk.run(['python', '-c', SETUPTOOLS_SHIM, 'bdist_wheel', '-d', tmp],
+                    cwd=pk.build_path)
+        except subprocess.CalledProcessError:
+            logger.warning("Could not build a wheel for %s" % pk.fullname)
+            return None
+
+        if not find(tmp):
+            return None
+        os.rename(tmp, path)
+    return find(path)
+
+# what setup.py install writes for console_scripts and gui_scripts
+SCRIPT_TEMPLATE = """#!/usr/bin/env python
+import sys
+from %(module)s import %(import_name)s
+
+if __name__ == '__main__':
+    sys.exit(%(func)s())
+"""
+
+def entry_scripts(zf):
+    """ (name, module, func) of the scripts declared as wheel entry points """
+    names = [
+        n for n in zf.namelist() if n.count('/') == 1 and
+            n.split('/')[0].endswith('.dist-info') and
+            n.endswith('/entry_points.txt')
+    ]
+    if not names:
+        return []
+
+    parser = ConfigParser.RawConfigParser()
+    parser.optionxform = str
+    parser.readfp(StringIO.StringIO(zf.read(names[0])))
+
+    scripts = []
+    for section in ('console_scripts', 'gui_scripts'):
+        if not parser.has_section(section):
+            continue
+        for name, value in parser.items(section):
+            # module:attr.path [extras]
+            module, func = value.split('[')[0].strip().split(':')
+            scripts.append((name, module.strip(), func.strip()))
+    return scripts
+
+def write_script(path, module, func):
+    with open(path, 'w') as f:
+        f.write(SCRIPT_TEMPLATE % dict(
+            module=module, import_name=func.split('.')[0], func=func
+        ))
+    os.chmod(path, 0755)
+
+def unpack(whl, pk):
+    """ Install the wheel `whl` into the install path of the package `pk` """
+    targets = {
+        'purelib': pk.pythonpath,
+        'platlib': pk.pythonpath,
+        'scripts': pk.pythonbinpath,
+        'headers': join(pk.install_path, 'include', pk.name),
+        'data': pk.install_path,
+    }
+
+    logger.info("Unpacking %s" % os.path.basename(whl))
+    with zipfile.ZipFile(whl) as zf:
+        for info in zf.infolist():
+            parts = info.filename.split('/')
+            if info.filename.endswith('/'):
+                continue
+
+            if parts[0].endswith('.data') and len(parts) > 2:
+                target = join(targets[parts[1]], *parts[2:])
+                script = parts[1] == 'scripts'
+            else:
+                target = join(pk.pythonpath, *parts)
+                script = False
+
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+
+            data = zf.read(info)
+            if script and data.startswith('#!python'):
+                data = '#!/usr/bin/env python' + data[len('#!python'):]
+
+            with open(target, 'wb') as f:
+                f.write(data)
+
+            mode = (info.external_attr >> 16) & 0777
+            if script:
+                mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+            if mode:
+                os.chmod(target, mode)
+
+        # wheels leave generating these to the installer
+        for name, module, func in entry_scripts(zf):
+            if not os.path.isdir(pk.pythonbinpath):
+                os.makedirs(pk.pythonbinpath)
+            write_script(join(pk.pythonbinpath, name), module, func)
@@ -13,7 +13,7 @@ setup(
     author_email='mkb72@cornell.edu',
     url='http://www.python.org/sigs/distutils-sig/',
     packages=['chip'],
-    scripts=['bin/chip'],
+    scripts=['bin/chip', 'bin/chipd'],
     install_requires=[
         "argcomplete==0.8.1",
         "argparse==1.2.1",
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+Benchmarks for chip's resolution, export and completion paths at catalog
+scale.  A synthetic catalog is generated into a throwaway home directory so
+that everything runs offline: package sources are local stub directories
+referenced by file:// urls and builds are trivial.
+
+Typical usage:
+
+    python tests/bench.py --packages 500 --versions 4 --fanout 3 --depth 4
+    python tests/bench.py -o new.json --compare old.json
+
+Results are written as json (to stdout or --output) so that runs can be
+compared against each other to detect regressions.
+"""
+import os
+import sys
+import imp
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import platform
+
+join = os.path.join
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#=============================================================================
+# synthetic catalog generation
+#=============================================================================
+STUB_SETUP = \
+"""from distutils.core import setup
+setup(name='{name}', version='{version}', py_modules=['{module}'])
+"""
+
+STUB_BINARY = \
+"""#!/bin/sh
+echo {name}
+"""
+
+def version_list(nversions):
+    return ["%d.%d.0" % (1 + v // 2, v % 2) for v in xrange(nversions)]
+
+def write_stub(srcdir, name, version, ptype):
+    """ Create the local source tree that a file:// url points to """
+    path = join(srcdir, "%s-%s" % (name, version))
+    os.makedirs(path)
+
+    if ptype == 'python':
+        module = name.replace('-', '_')
+        with open(join(path, 'setup.py'), 'w') as f:
+            f.write(STUB_SETUP.format(name=name, version=version, module=module))
+        with open(join(path, module+'.py'), 'w') as f:
+            f.write("VERSION = %r\n" % version)
+
+    if ptype == 'binary':
+        exe = join(path, name)
+        with open(exe, 'w') as f:
+            f.write(STUB_BINARY.format(name=name))
+        os.chmod(exe, 0755)
+
+    return 'file://'+path
+
+def generate_catalog(srcdir, npackages=200, nversions=3, fanout=3, depth=4,
+        diamonds=0.3, seed=0):
+    """
+    Build a list of package descriptions in the same format as
+    tests/packages.json.  Packages are spread over `depth`+1 levels, each
+    package requiring `fanout` packages from the level below it.  With
+    probability `diamonds` a requirement is drawn from a small set of hub
+    packages shared by the whole level, which produces diamond shaped
+    dependency graphs.
+    """
+    rand = random.Random(seed)
+    types = ['meta', 'python', 'binary']
+
+    levels = [[] for i in xrange(depth+1)]
+    for i in xrange(npackages):
+        levels[i % (depth+1)].append("pkg-%05d" % i)
+
+    specs = ["~= 1.0", "~= 1.0.0", ">= 1.0"]
+    versions = version_list(nversions)
+
+    pks = []
+    for level, names in enumerate(levels):
+        below = levels[level+1] if level < depth else []
+        hubs = below[:max(1, len(below)/10)]
+
+        for name in names:
+            requires = {}
+            for i in xrange(min(fanout, len(below))):
+                pool = hubs if rand.random() < diamonds else below
+                requires[rand.choice(pool)] = rand.choice(specs)
+
+            ptype = types[rand.randint(0, len(types)-1)]
+            for version in versions:
+                pk = {
+                    "name": name,
+                    "author": "chip-bench",
+                    "desc": "Synthetic benchmark package",
+                    "type": ptype,
+                    "version": version,
+                    "date": "2014-08-18",
+                    "requires": requires,
+                }
+                if ptype != 'meta':
+                    pk['url'] = write_stub(srcdir, name, version, ptype)
+                if ptype == 'binary':
+                    pk['data'] = {"linkname": name}
+                pks.append(pk)
+
+    return pks, levels[0]
+
+#=============================================================================
+# a temporary chip home, the modules must only be imported after this is set
+#=============================================================================
+def setup_home(args):
+    tmp = tempfile.mkdtemp(prefix='chip-bench-')
+    os.environ['HOME'] = tmp
+    open(join(tmp, '.bashrc'), 'w').close()
+
+    home = join(tmp, 'openkim-packages')
+    pkfile = join(home, 'packages.json')
+    srcdir = join(tmp, 'sources')
+    confdir = join(tmp, '.kim-chip')
+    for d in [home, srcdir, confdir]:
+        os.makedirs(d)
+
+    pks, roots = generate_catalog(srcdir, args.packages, args.versions,
+            args.fanout, args.depth, args.diamonds, args.seed)
+    with open(pkfile, 'w') as f:
+        json.dump(pks, f)
+
+    with open(join(confdir, 'chip.json'), 'w') as f:
+        json.dump({"url": "file://"+pkfile, "home": home, "pkfile": pkfile}, f)
+
+    return tmp, pks, roots
+
+def load_chip():
+    sys.path.insert(0, ROOT)
+    from chip import log
+
+    # chip logs to stdout, which is where the results go.  Set its logger up
+    # before anything logs on import and move the console output to stderr.
+    logger = log.createLogger(join(os.environ['HOME'], '.kim-chip', 'chip.log'))
+    for handler in logger.handlers:
+        if type(handler) is log.logging.StreamHandler:
+            handler.stream = sys.stderr
+    log.setLevel(log.logging.WARNING)
+
+    from chip import util, packages, conf
+    cli = imp.load_source('chipcli', join(ROOT, 'bin', 'chip'))
+    return util, packages, conf, cli
+
+#=============================================================================
+# timing helpers
+#=============================================================================
+def measure(func, repeat, reset):
+    times = []
+    for i in xrange(repeat):
+        reset()
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+    return {
+        "min": min(times),
+        "mean": sum(times) / len(times),
+        "max": max(times),
+        "repeat": repeat,
+    }
+
+def run_benchmarks(args):
+    tmp, pks, roots = setup_home(args)
+    util, packages, conf, cli = load_chip()
+
+    def reset():
+        """ Drop in-process caches so that each repetition starts cold """
+        util.gpks = None
+        util._versions.clear()
+        util._specifiers.clear()
+        packages._packages.clear()
+
+    names = sorted(set(pk['name'] for pk in pks))
+    fullnames = [util.format_pk_name(pk['name'], pk['version']) for pk in pks]
+    roots = roots[:args.roots]
+
+    def latest():
+        for name in names:
+            util.get_latest_version(name)
+
+    def match():
+        for name in names:
+            util.get_match_version(name, "~= 1.0")
+
+    def dependencies():
+        for root in roots:
+            packages.pkg_obj(root).dependencies
+
+    deplist = []
+    for root in roots:
+        pk = packages.pkg_obj(root)
+        deplist.extend([pk]+pk.dependencies)
+
+    def versiondict():
+        packages.CompatibleVersionDict(deplist).tolist()
+
+    conf.env_switch('bench')
+    conf.env_save(roots, 'bench')
+
+    def export():
+        cli.action_export({})
+
+    def complete_names():
+        cli.GlobalPackageCompleter('pkg-', None)
+
+    def complete_fullnames():
+        cli.GlobalPackageCompleter('pkg-00000@', None)
+
+    def complete_installed():
+        cli.InstalledPackageCompleter('', None)
+
+    cases = [
+        ("get_latest_version", latest, len(names)),
+        ("get_match_version", match, len(names)),
+        ("Package.dependencies", dependencies, len(roots)),
+        ("CompatibleVersionDict", versiondict, len(deplist)),
+        ("action_export", export, len(roots)),
+        ("complete_names", complete_names, len(names)),
+        ("complete_fullnames", complete_fullnames, len(fullnames)),
+        ("complete_installed", complete_installed, len(fullnames)),
+    ]
+
+    if args.install:
+        from chip import verify
+
+        def install():
+            for root in roots:
+                packages.pkg_obj(root).install()
+
+        def uninstall():
+            reset()
+            home = conf.read_conf()['home']
+            for d in os.listdir(home):
+                if util.is_fullname(d):
+                    os.remove(join(home, d))
+            if os.path.isdir(join(home, '.store')):
+                shutil.rmtree(join(home, '.store'))
+
+        def installed():
+            return [packages.Package(n, search=False)
+                    for n in packages.installed_packages()]
+
+        def check():
+            verify.check(installed())
+
+        def check_fast():
+            verify.check(installed(), fast=True)
+
+        cases.append(("install", install, len(roots)))
+        # run after install, on the trees it leaves behind
+        cases.append(("verify", check, len(roots)))
+        cases.append(("verify_fast", check_fast, len(roots)))
+
+    results = {}
+    for name, func, n in cases:
+        if args.filter and args.filter not in name:
+            continue
+        r = measure(func, args.repeat, reset if name != 'install' else uninstall)
+        r['n'] = n
+        results[name] = r
+
+    if not args.keep:
+        shutil.rmtree(tmp)
+
+    return {
+        "params": {
+            "packages": args.packages, "versions": args.versions,
+            "fanout": args.fanout, "depth": args.depth,
+            "diamonds": args.diamonds, "seed": args.seed,
+            "roots": len(roots), "catalog": len(pks),
+        },
+        "python": platform.python_version(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": results,
+    }
+
+def compare(new, old, threshold):
+    """ Return a list of the benchmarks slower than `threshold` x old """
+    regressions = []
+    for name, res in new['results'].iteritems():
+        ref = old['results'].get(name)
+        if not ref or ref['min'] <= 0:
+            continue
+        ratio = res['min'] / ref['min']
+        if ratio > threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packages", type=int, default=200,
+        help="number of distinct packages in the synthetic catalog")
+    parser.add_argument("--versions", type=int, default=3,
+        help="number of versions of each package")
+    parser.add_argument("--fanout", type=int, default=3,
+        help="number of requirements of each package")
+    parser.add_argument("--depth", type=int, default=4,
+        help="number of levels in the dependency graph")
+    parser.add_argument("--diamonds", type=float, default=0.3,
+        help="probability of a requirement being a shared hub package")
+    parser.add_argument("--roots", type=int, default=5,
+        help="number of top level packages to resolve and export")
+    parser.add_argument("--seed", type=int, default=0,
+        help="random seed for the catalog generator")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="number of repetitions of each benchmark")
+    parser.add_argument("--filter", type=str, default='',
+        help="only run benchmarks whose name contains this string")
+    parser.add_argument("--install", action='store_true',
+        help="also time installing the root packages from stub sources")
+    parser.add_argument("--keep", action='store_true',
+        help="do not delete the temporary chip home when finished")
+    parser.add_argument("-o", "--output", type=str, default='',
+        help="write the json results to this file instead of stdout")
+    parser.add_argument("--compare", type=str, default='',
+        help="json results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+        help="slowdown ratio against --compare considered a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    else:
+        print json.dumps(results, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(results, old, args.threshold)
+        for name, ratio in regressions:
+            sys.stderr.write("REGRESSION %s: %.2fx slower\n" % (name, ratio))
+        sys.exit(1 if regressions else 0)
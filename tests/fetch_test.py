@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Tests of chip's downloads against a local http server.  The server speaks
+HTTP/1.1 with keep-alive, answers Range requests and can be told to drop
+connections halfway through a response or to hang up on idle ones, so
+resuming, checksums, connection reuse and the bound on concurrent downloads
+are all exercised offline.
+
+    python tests/fetch_test.py
+"""
+import os
+import re
+import sys
+import time
+import socket
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+import multiprocessing
+
+join = os.path.join
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# chip reads its configuration from the home directory on import
+HOME = tempfile.mkdtemp(prefix='chip-fetch-')
+os.environ['HOME'] = HOME
+sys.path.insert(0, ROOT)
+
+from chip import log
+log.createLogger(join(HOME, '.kim-chip', 'chip.log'))
+log.setStream(sys.stderr)
+log.setLevel(log.logging.WARNING)
+from chip import conf, util, fetch
+
+#=============================================================================
+# a local server
+#=============================================================================
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.files = files
+        self.drops = 0
+        self.delay = 0
+        self.hangup = False
+        self.requests = []
+        self.active, self.most = 0, 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        data = server.files.get(self.path.lstrip('/'))
+        rng = self.headers.get('Range')
+        with server.lock:
+            server.requests.append((self.path, rng, self.client_address[1]))
+            server.active += 1
+            server.most = max(server.most, server.active)
+            drop = server.drops > 0
+            if drop:
+                server.drops -= 1
+        try:
+            if data is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            start = int(re.match(r'bytes=(\d+)-', rng).group(1)) if rng else 0
+            if rng:
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                        (start, len(data)-1, len(data)))
+            else:
+                self.send_response(200)
+            body = data[start:]
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+
+            time.sleep(server.delay)
+            if drop:
+                self.wfile.write(body[:len(body)//3])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            self.wfile.write(body)
+            # close a keep-alive connection without saying so, the client
+            # only finds out when it uses the connection again
+            self.close_connection = server.hangup
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+def fetch_one(url, dest):
+    fetch.download(url, dest)
+
+#=============================================================================
+# the tests
+#=============================================================================
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(1 << 20)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.server = Server({'big.bin': self.data, 'small.bin': 'x'*1000})
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.dir = tempfile.mkdtemp(dir=HOME)
+
+    def tearDown(self):
+        fetch.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_resume(self):
+        self.server.drops = 2
+        dest = join(self.dir, 'big.bin')
+        fetch.download(self.server.url+'big.bin', dest, self.sha256)
+
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(dest+'.part'))
+        ranges = [r[1] for r in self.server.requests]
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(ranges[0], None)
+        self.assertTrue(all(r and r != 'bytes=0-' for r in ranges[1:]))
+
+    def test_checksum(self):
+        dest = join(self.dir, 'big.bin')
+        with self.assertRaises(util.PackageError):
+            fetch.download(self.server.url+'big.bin', dest, '0'*64)
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(os.path.exists(dest+'.part'))
+
+    def test_missing(self):
+        with self.assertRaises(util.PackageError):
+            fetch.download(self.server.url+'nothing', join(self.dir, 'x'))
+
+    def test_keepalive(self):
+        for i in xrange(3):
+            fetch.download(self.server.url+'small.bin', join(self.dir, str(i)))
+        ports = set(r[2] for r in self.server.requests)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(ports), 1)
+
+    def test_stale_connection(self):
+        self.server.hangup = True
+        fetch.download(self.server.url+'small.bin', join(self.dir, 'small'))
+
+        # resume over the pooled connection the server has closed
+        dest = join(self.dir, 'big.bin')
+        with open(dest+'.part', 'wb') as f:
+            f.write(self.data[:1000])
+        fetch.download(self.server.url+'big.bin', dest, self.sha256)
+
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(self.server.requests[-1][1], 'bytes=1000-')
+        self.assertEqual(len(set(r[2] for r in self.server.requests)), 2)
+
+    def test_same_dest(self):
+        self.server.delay = 0.3
+        dest = join(self.dir, 'big.bin')
+        procs = [
+            multiprocessing.Process(target=fetch_one, args=(
+                self.server.url+'big.bin', dest))
+            for i in xrange(4)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+        self.assertTrue(all(p.exitcode == 0 for p in procs))
+        self.assertEqual(len(self.server.requests), 1)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_bound_across_processes(self):
+        self.server.delay = 0.3
+        procs = [
+            multiprocessing.Process(target=fetch_one, args=(
+                self.server.url+'small.bin', join(self.dir, str(i))))
+            for i in xrange(3*fetch.MAX_DOWNLOADS)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+        self.assertTrue(all(p.exitcode == 0 for p in procs))
+        self.assertEqual(len(self.server.requests), len(procs))
+        self.assertTrue(self.server.most <= fetch.MAX_DOWNLOADS)
+
+if __name__ == "__main__":
+    try:
+        unittest.main()
+    finally:
+        shutil.rmtree(HOME)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Tests of how dependency lists are merged by version.  The cases pin down
+which versions CompatibleVersionDict keeps together, so that changes made
+for speed do not change resolution results.
+
+    python tests/versions_test.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+join = os.path.join
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# chip reads its configuration from the home directory on import
+HOME = tempfile.mkdtemp(prefix='chip-versions-')
+os.environ['HOME'] = HOME
+sys.path.insert(0, ROOT)
+
+from chip import log
+log.createLogger(join(HOME, '.kim-chip', 'chip.log'))
+log.setStream(sys.stderr)
+log.setLevel(log.logging.WARNING)
+from chip import packages
+
+class Pk(object):
+    def __init__(self, fullname):
+        self.name, self.version = fullname.split('@')
+
+    def __repr__(self):
+        return '%s@%s' % (self.name, self.version)
+
+def merged(*fullnames):
+    """ The versions kept of `fullnames`, merged in both orders """
+    results = []
+    for names in (fullnames, fullnames[::-1]):
+        d = packages.CompatibleVersionDict([Pk(n) for n in names])
+        results.append(sorted(pk.version for pk in d.tolist()))
+    return results
+
+class CompatibleVersionDictTest(unittest.TestCase):
+    def assertMerged(self, fullnames, kept):
+        for result in merged(*fullnames):
+            self.assertEqual(result, kept)
+
+    def test_same_bucket(self):
+        self.assertMerged(['a@1.6.2', 'a@1.6.3'], ['1.6.3'])
+        self.assertMerged(['a@1.6', 'a@1.9'], ['1.9'])
+
+    def test_trailing_zero(self):
+        for result in merged('a@1.6', 'a@1.6.0'):
+            self.assertEqual(len(result), 1)
+        self.assertMerged(['a@1.6', 'a@1.6.0', 'a@1.6.1'], ['1.6.1'])
+
+    def test_release_lengths(self):
+        self.assertMerged(['a@1.6.3', 'a@1.6'], ['1.6.3'])
+        self.assertMerged(['a@1.6.3', 'a@1.7'], ['1.6.3', '1.7'])
+
+    def test_conflicts(self):
+        self.assertMerged(['a@1.6.0', 'a@1.7.0'], ['1.6.0', '1.7.0'])
+        self.assertMerged(['a@1.6', 'a@2.0'], ['1.6', '2.0'])
+        self.assertMerged(['a@1', 'a@1.6'], ['1', '1.6'])
+
+    def test_names(self):
+        d = packages.CompatibleVersionDict([Pk('a@1.6'), Pk('b@1.6.3')])
+        self.assertEqual(d.compatible(), (True, []))
+
+if __name__ == "__main__":
+    try:
+        unittest.main()
+    finally:
+        shutil.rmtree(HOME)